@@ -0,0 +1,259 @@
+"""
+Near-duplicate detection across the saved/liked Instagram media: the same meme or reel
+downloaded from different posts (or carousels).
+
+Each image, and a keyframe of each video, gets a 64 bit perceptual hash (dHash), computed
+in a process pool and cached in SQLite (only new or changed files are hashed again).
+The hashes go in a BK-tree, so that finding everything within a Hamming distance of a
+file doesn't compare it against the whole collection.
+
+	python instagram-duplicates.py                 # report the groups of near-duplicates
+	python instagram-duplicates.py --distance 4    # stricter
+	python instagram-duplicates.py --hardlink      # also hardlink the copies with identical content
+"""
+import io
+import os
+import sys
+import sqlite3
+import hashlib
+import argparse
+import subprocess
+import multiprocessing
+
+from PIL import Image
+
+import config
+
+HASH_CACHE_FILE = config.CACHE_DIR / "instagram-phash.sqlite3"
+REPORT_FILE = config.CACHE_DIR / "instagram-duplicates.txt"
+# Massima distanza di Hamming (su 64 bit) tra due media considerati lo stesso contenuto
+DEFAULT_DISTANCE = 6
+
+SOURCES = {
+	"instagram-saved": config.INSTAGRAM_SAVED_DIR,
+	"instagram-liked": config.INSTAGRAM_LIKED_DIR,
+}
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".heic")
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".webm", ".mkv")
+
+def open_cache(path = HASH_CACHE_FILE):
+	conn = sqlite3.connect(str(path))
+	conn.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, kind TEXT, hash TEXT)")
+	return conn
+
+def scan_media(root):
+	"""Elenca ricorsivamente (path, size, mtime_ns, kind) di immagini e video sotto root, saltando le cartelle metadata e metadata-only."""
+	stack = [str(root)]
+	while stack:
+		with os.scandir(stack.pop()) as it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks=False):
+					if entry.name not in ("metadata", "metadata-only"):
+						stack.append(entry.path)
+				elif entry.is_file():
+					ext = os.path.splitext(entry.name)[1].lower()
+					kind = "image" if ext in IMAGE_EXTENSIONS else "video" if ext in VIDEO_EXTENSIONS else None
+					if kind is not None:
+						st = entry.stat()
+						yield entry.path, st.st_size, st.st_mtime_ns, kind
+
+def dhash(image):
+	"""Difference hash: 8x8 confronti tra pixel adiacenti dell'immagine ridotta a 9x8 in scala di grigi."""
+	pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+	value = 0
+	for row in range(8):
+		for col in range(8):
+			value = (value << 1) | (pixels[row * 9 + col] < pixels[row * 9 + col + 1])
+	return value
+
+def video_keyframe(path):
+	"""Il primo keyframe dopo un secondo (o dall'inizio, per i video più corti), estratto con ffmpeg."""
+	for seek in (["-ss", "1"], []):
+		result = subprocess.run(
+			["ffmpeg", "-v", "error"] + seek + ["-skip_frame", "nokey", "-i", path, "-frames:v", "1", "-f", "image2pipe", "-vcodec", "png", "-"],
+			stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+		)
+		if result.returncode == 0 and len(result.stdout) > 0:
+			return Image.open(io.BytesIO(result.stdout))
+	raise Exception("ffmpeg could not extract a keyframe")
+
+def hash_media(args):
+	"""Eseguita nei worker: restituisce (path, size, mtime_ns, kind, hash in esadecimale o None)."""
+	path, size, mtime_ns, kind = args
+	try:
+		if kind == "image":
+			with Image.open(path) as image:
+				value = dhash(image)
+		else:
+			value = dhash(video_keyframe(path))
+	except Exception as e:
+		print(f"\nWarning: cannot hash {path} ({e})")
+		return path, size, mtime_ns, kind, None
+	return path, size, mtime_ns, kind, f"{value:016x}"
+
+def update_hashes(conn, n_workers):
+	"""Calcola gli hash dei media nuovi o cambiati; restituisce {path: (kind, hash)} di tutti i media presenti."""
+	cached = {
+		path: (size, mtime_ns, kind, value)
+		for path, size, mtime_ns, kind, value in conn.execute("SELECT path, size, mtime_ns, kind, hash FROM hashes")
+	}
+	media = {}
+	to_hash = []
+	for source, root in SOURCES.items():
+		if not os.path.isdir(root):
+			continue
+		for path, size, mtime_ns, kind in scan_media(root):
+			row = cached.get(path)
+			if row is not None and row[:2] == (size, mtime_ns):
+				if row[3] is not None:
+					media[path] = (row[2], row[3])
+			else:
+				to_hash.append((path, size, mtime_ns, kind))
+	print(f"{len(media)} cached hashes, {len(to_hash)} files to hash.")
+
+	if len(to_hash) > 0:
+		with multiprocessing.Pool(n_workers) as pool:
+			for i, (path, size, mtime_ns, kind, value) in enumerate(pool.imap_unordered(hash_media, to_hash, chunksize=16), 1):
+				conn.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", (path, size, mtime_ns, kind, value))
+				if value is not None:
+					media[path] = (kind, value)
+				if i % 500 == 0:
+					conn.commit()
+				print(f"\r{i} / {len(to_hash)}", end="")
+				sys.stdout.flush()
+		print()
+
+	# I media spariti non servono più
+	conn.executemany("DELETE FROM hashes WHERE path = ?", [(path,) for path in cached if not os.path.exists(path)])
+	conn.commit()
+	return media
+
+def hamming(a, b):
+	return bin(a ^ b).count("1")
+
+class BKTree:
+	"""
+	BK-tree sulla distanza di Hamming: ogni figlio di un nodo è indicizzato dalla sua distanza dal nodo.
+	Per la disuguaglianza triangolare una ricerca entro radius visita solo i figli a distanza
+	d - radius..d + radius, cioè una piccola parte dell'albero.
+	"""
+	def __init__(self):
+		# Nodo: [hash, lista dei path con quell'hash, {distanza: nodo figlio}]
+		self.root = None
+
+	def add(self, value, path):
+		if self.root is None:
+			self.root = [value, [path], {}]
+			return
+		node = self.root
+		while True:
+			d = hamming(value, node[0])
+			if d == 0:
+				node[1].append(path)
+				return
+			child = node[2].get(d)
+			if child is None:
+				node[2][d] = [value, [path], {}]
+				return
+			node = child
+
+	def query(self, value, radius):
+		"""I path con hash entro radius da value."""
+		result = []
+		stack = [self.root] if self.root is not None else []
+		while stack:
+			node = stack.pop()
+			d = hamming(value, node[0])
+			if d <= radius:
+				result.extend(node[1])
+			for child_d, child in node[2].items():
+				if d - radius <= child_d <= d + radius:
+					stack.append(child)
+		return result
+
+def find_groups(media, radius):
+	"""Raggruppa (union-find) i media entro radius l'uno dall'altro; immagini e video separatamente."""
+	parent = {path: path for path in media}
+	def find(path):
+		while parent[path] != path:
+			parent[path] = parent[parent[path]]
+			path = parent[path]
+		return path
+
+	for kind in ("image", "video"):
+		tree = BKTree()
+		for path in sorted(media):
+			if media[path][0] == kind:
+				tree.add(int(media[path][1], 16), path)
+		for path in sorted(media):
+			if media[path][0] != kind:
+				continue
+			for other in tree.query(int(media[path][1], 16), radius):
+				a, b = find(path), find(other)
+				if a != b:
+					parent[max(a, b)] = min(a, b)
+
+	groups = {}
+	for path in sorted(media):
+		groups.setdefault(find(path), []).append(path)
+	return [group for group in groups.values() if len(group) > 1]
+
+def file_digest(path):
+	h = hashlib.sha1()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1 << 20), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+def hardlink_identical(group):
+	"""
+	Sostituisce con un hardlink le copie del gruppo con contenuto identico (stessa dimensione e hash)
+	e la stessa data di modifica, che gallery-dl prende dal post: così nessun file perde la sua.
+	Le copie solo simili restano: ognuna ha i metadati EXIF del proprio post. Se poi lib.py scrive
+	i tag di un post in una copia linkata, prima la separa (vedi lib.unshare_file).
+	Restituisce i byte risparmiati.
+	"""
+	by_content = {}
+	for path in group:
+		st = os.stat(path)
+		by_content.setdefault((st.st_size, st.st_mtime_ns, file_digest(path)), []).append((path, st))
+	saved = 0
+	for (size, _, _), copies in by_content.items():
+		keep, keep_st = copies[0]
+		for path, st in copies[1:]:
+			if (st.st_dev, st.st_ino) == (keep_st.st_dev, keep_st.st_ino):
+				continue
+			tmp_path = path + ".hardlink.tmp"
+			try:
+				os.link(keep, tmp_path)
+				os.replace(tmp_path, path)
+			except OSError as e:
+				print(f"Cannot hardlink {path} ({e})")
+				continue
+			saved += size
+	return saved
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Find the near-duplicate images and videos among the saved/liked Instagram media.")
+	parser.add_argument("--distance", type=int, default=DEFAULT_DISTANCE, help="maximum Hamming distance between the 64 bit hashes of two duplicates")
+	parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of hashing processes")
+	parser.add_argument("--hardlink", action="store_true", help="replace the byte-identical copies with the same mtime with hardlinks to a single file")
+	parser.add_argument("--report", default=str(REPORT_FILE), help="where to write the groups of duplicates")
+	args = parser.parse_args()
+
+	conn = open_cache()
+	media = update_hashes(conn, args.workers)
+	conn.close()
+
+	groups = find_groups(media, args.distance)
+	saved = 0
+	with open(args.report, "w", encoding="utf-8") as report:
+		for group in groups:
+			for path in group:
+				report.write(f"{media[path][1]}\t{path}\n")
+			report.write("\n")
+			if args.hardlink:
+				saved += hardlink_identical(group)
+	print(f"{len(groups)} groups of near-duplicates, {sum(len(g) for g in groups)} files (see {args.report})")
+	if args.hardlink:
+		print(f"Hardlinks saved {saved / 2**20:.1f} MB.")
@@ -1,11 +1,18 @@
+import io
 import json
 import sys
+import argparse
 import datetime
 import random
 import time
 import os
 import config
 import shutil
+import hashlib
+import heapq
+import itertools
+import threading
+import contextlib
 import os.path as osp
 import lib
 from dotenv import load_dotenv
@@ -20,16 +27,36 @@ INSTAGRAM_BASE_DIR = os.getenv('INSTAGRAM_BASE_DIR')
 # - Head to https://www.instagram.com/
 # - Download cookies from current container.
 COOKIES_FILE = str(config.CACHE_DIR / "cookies.Facebook.txt")
+# Lists of done and blacklisted URLs (see lib.StateStore)
+STATE_FILE = str(config.CACHE_DIR / "instagram-state.sqlite3")
+# Old json lists, migrated into STATE_FILE on the first run
 DONE_FILE = str(config.CACHE_DIR / "instagram-done.json")
 BLACKLIST_FILE = str(config.CACHE_DIR / "instagram-blacklist.json")
 GALLERY_DL_DONE_FILE = str(config.CACHE_DIR / "gallery-dl-done.sqlite3")
 
 
 SLEEP_MIN, SLEEP_MAX = 10, 20 # seconds
-
-TARGET = "saved"
-if len(sys.argv) > 1:
-	TARGET = sys.argv[1]
+# Parallel download workers; they all share the same request budget (see `bucket`), and yt-dlp and
+# gallery-dl each run one download at a time (see `ydl_lock`, `gallery_dl_lock`): with 2 workers a video
+# and a post overlap, more would only wait for the locks
+N_WORKERS = int(os.getenv('INSTAGRAM_WORKERS', '2'))
+# Transient errors (5xx, timeouts, 429) are retried up to MAX_ATTEMPTS times, after RETRY_DELAY * 2^n seconds
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 60 # seconds
+# On a rate limit, all the workers stop for RATE_LIMIT_PAUSE seconds, doubled if it happens again
+RATE_LIMIT_PAUSE, RATE_LIMIT_MAX_PAUSE = 15 * 60, 4 * 60 * 60 # seconds
+
+parser = argparse.ArgumentParser(description="Download the saved or liked Instagram posts of a takeout.")
+parser.add_argument("target", nargs="?", default="saved", help="saved or liked")
+parser.add_argument("--tag", action="store_true", help="write the EXIF metadata of each file right after its download (instead of running lib.py afterwards)")
+parser.add_argument("--metadata-only", action="store_true", help="only fetch the metadata json's (author, caption, date), not the media")
+parser.add_argument("--thumbnail", action="store_true", help="with --metadata-only, also save the thumbnails of the videos")
+parser.add_argument("--max-filesize", type=int, metavar="MB", help="skip the files larger than MB megabytes (the metadata is still saved)")
+args = parser.parse_args()
+if args.thumbnail and not args.metadata_only:
+	parser.error("--thumbnail requires --metadata-only")
+
+TARGET = args.target
 
 if TARGET == "saved":
 	TARGET_DIR = os.path.join(os.getenv('TARGET_DIR', 'takeout-downloaded'), "instagram-saved")
@@ -52,23 +79,96 @@ print("INSTAGRAM_BASE_DIR: ", INSTAGRAM_BASE_DIR)
 print("TARGET_DIR: ", TARGET_DIR)
 print()
 
-def parse_list(source_json_filepath, source_key):
-	with open(osp.join(INSTAGRAM_BASE_DIR, source_json_filepath), "r") as f:
-		data = json.load(f)
+def iter_json_array(path, key, chunk_size = 1 << 16):
+	"""
+	Yields one by one the elements of the array `key` of a json file, reading it in chunks
+	(the takeout lists can be huge, we never hold the whole document in memory).
+	"""
+	decoder = json.JSONDecoder()
+	marker = f'"{key}"'
+	with open(path, "r", encoding="utf-8") as f:
+		buf = ""
+		eof = False
+		def read_more():
+			nonlocal buf, eof
+			chunk = f.read(chunk_size)
+			eof = chunk == ""
+			buf += chunk
+		# Find the opening bracket of the array
+		while True:
+			start = buf.find(marker)
+			bracket = buf.find("[", start) if start >= 0 else -1
+			if bracket >= 0:
+				buf = buf[bracket+1:]
+				break
+			if eof:
+				raise Exception(f"Key {key} not found in {path}")
+			if start < 0:
+				buf = buf[-len(marker):]
+			read_more()
+		pos = 0
+		while True:
+			while pos < len(buf) and buf[pos] in " \t\r\n,":
+				pos += 1
+			if pos < len(buf) and buf[pos] == "]":
+				return
+			try:
+				element, pos = decoder.raw_decode(buf, pos)
+			except json.JSONDecodeError:
+				if eof:
+					raise
+				buf = buf[pos:]
+				pos = 0
+				read_more()
+				continue
+			yield element
+
+def parse_entry(post, source_key):
 	if source_key == "saved_saved_media":
-		_saved_ons = [post["string_map_data"] for post in data[source_key]]
-		assert(set(map(len, _saved_ons)) == set([1]))
-		saved_ons = [post["Saved on"] for post in _saved_ons]
+		assert(len(post["string_map_data"]) == 1)
+		saved_on = post["string_map_data"]["Saved on"]
 	elif source_key == "likes_media_likes":
-		_saved_ons = [post["string_list_data"] for post in data[source_key]]
-		assert(set(map(len, _saved_ons)) == set([1]))
-		saved_ons = [post[0] for post in _saved_ons]
+		assert(len(post["string_list_data"]) == 1)
+		saved_on = post["string_list_data"][0]
 	else:
 		raise(Exception(f"Unknown source_key: {source_key}"))
-	saved_ons = [(saved_on["href"], saved_on["timestamp"]) for saved_on in saved_ons]
-	saved_ons = list(reversed(sorted(saved_ons, key = lambda x : x[1])))
+	return saved_on["href"], saved_on["timestamp"]
+
+def list_signature(path, source_key):
+	"""Identifies a version of a takeout list: its cached parsings are valid as long as it doesn't change."""
+	st = os.stat(path)
+	return f"{st.st_size} {st.st_mtime_ns} {source_key}"
+
+def parse_list(source_json_filepath, source_key):
+	"""
+	The (url, timestamp) pairs of a takeout list, newest first. They are cached as a tsv
+	in CACHE_DIR, valid as long as the size and mtime of the json file don't change.
+	"""
+	path = osp.join(INSTAGRAM_BASE_DIR, source_json_filepath)
+	signature = f"# {list_signature(path, source_key)}\n"
+	cache_path = str(config.CACHE_DIR / f"instagram-links-{source_key}.tsv")
+
+	saved_ons = None
+	if osp.exists(cache_path):
+		with open(cache_path, "r", encoding="utf-8") as f:
+			if f.readline() == signature:
+				saved_ons = []
+				for line in f:
+					url, timestamp = line.rstrip("\n").split("\t")
+					saved_ons.append((url, int(timestamp)))
+
+	if saved_ons is None:
+		saved_ons = [parse_entry(post, source_key) for post in iter_json_array(path, source_key)]
+		saved_ons = list(reversed(sorted(saved_ons, key = lambda x : x[1])))
+		os.makedirs(config.CACHE_DIR, exist_ok=True)
+		with open(cache_path + ".tmp", "w", encoding="utf-8") as f:
+			f.write(signature)
+			for url, timestamp in saved_ons:
+				f.write(f"{url}\t{timestamp}\n")
+		os.replace(cache_path + ".tmp", cache_path)
+
 	# Oldest first
-	links = list(map(lambda x : x[0], saved_ons))
+	links = [url for url, _ in saved_ons]
 	url_to_timestamp = dict(saved_ons)
 	return url_to_timestamp, links
 
@@ -96,11 +196,21 @@ def get_date_str(url):
 # 		print(id)
 # 	return datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d_%H:%M:%S")
 
+state = lib.StateStore(STATE_FILE)
+state.migrate_json("done", DONE_FILE)
+state.migrate_json("blacklist", BLACKLIST_FILE)
+
 print("PARSING LINKS...")
 url_to_timestamp, links = parse_list(SOURCE_JSON_FILEPATH, SOURCE_KEY)
 
 if IGNORE is not None:
-	_, saved_links = parse_list(*IGNORE)
+	# The saved links, kept in the state store as the `ignore` list and re-read only when the saved list changes
+	ignore_path = osp.join(INSTAGRAM_BASE_DIR, IGNORE[0])
+	saved_links = state.sync(
+		"ignore",
+		list_signature(ignore_path, IGNORE[1]),
+		lambda: (parse_entry(post, IGNORE[1])[0] for post in iter_json_array(ignore_path, IGNORE[1])),
+	)
 	print(f"FOUND {len(links)} LINKS...")
 	print(f"REMOVING {len(saved_links)} SAVED LINKS...")
 	links = [l for l in links if not l in saved_links]
@@ -118,14 +228,8 @@ print()
 # Blacklist functionality
 # Some links are blacklisted because they return errors like "410 Gone" or "400 Bad Request"
 # This prevents the script from repeatedly trying to download unavailable content
-# You can manually edit the blacklist file to remove URLs if they become available again
-def load_blacklist():
-	if not os.path.isfile(BLACKLIST_FILE):
-		return []
-	with open(BLACKLIST_FILE, "r") as f:
-		return json.load(f)
-
-blacklist = load_blacklist()
+# You can manually remove URLs from the blacklist if they become available again (see README)
+blacklist = state.get("blacklist")
 
 to_download_links = [x for x in links if x not in blacklist]
 
@@ -172,168 +276,480 @@ if not os.path.isdir(TARGET_DIR):
 	print(f"Directory '{TARGET_DIR}' non trovata. Esco.")
 	sys.exit(1)
 
+# The metadata json's without a media file (--metadata-only, or files over --max-filesize) go to their own
+# directory: lib.py expects each json in metadata/ to have its media next to it
+METADATA_ONLY_DIR = "metadata-only"
+
 # Ensure the destination directory exists
 os.makedirs(osp.join(TARGET_DIR, "video"), exist_ok=True)
 os.makedirs(osp.join(TARGET_DIR, "video", "metadata"), exist_ok=True)
+os.makedirs(osp.join(TARGET_DIR, "video", METADATA_ONLY_DIR), exist_ok=True)
 os.makedirs(osp.join(TARGET_DIR, "post"), exist_ok=True)
 os.makedirs(osp.join(TARGET_DIR, "post", "metadata"), exist_ok=True)
+os.makedirs(osp.join(TARGET_DIR, "post", METADATA_ONLY_DIR), exist_ok=True)
+
+# The takeout date of the URL is passed to each extraction as the `takeout_date` field (see download_instagram_video)
+VIDEO_OUTTMPL = "%(takeout_date|)s%(id)s-%(upload_date>%Y-%m-%d-|)s%(title)s-%(timestamp)s_gdl.%(ext)s"
+
+# The YoutubeDL session, closed (saving the cookies) at the end of the run
+ydl_sessions = contextlib.ExitStack()
+ydl_lock = threading.Lock()
+_ydl = None
+
+def get_youtube_dl():
+	"""
+	The YoutubeDL session shared by all the video downloads, created on first use: the cookies
+	are loaded once and saved once, from a single jar. YoutubeDL is not thread-safe, so it must
+	only be used while holding ydl_lock.
+	"""
+	global _ydl
+	if _ydl is None:
+		ydl_opts = {
+			"overwrites" : False,
+			# "cookiesfrombrowser" : ('firefox', 'oi67r0nh.default-release', None),
+			"cookies" : COOKIES_FILE,
+			"outtmpl": osp.join(TARGET_DIR, "video", VIDEO_OUTTMPL),
+		}
+		if args.metadata_only:
+			ydl_opts["skip_download"] = True
+			ydl_opts["writethumbnail"] = args.thumbnail
+			# Next to the jsons: in video/ a thumbnail would look like the media of a later full download
+			ydl_opts["outtmpl"] = {
+				"default": ydl_opts["outtmpl"],
+				"thumbnail": osp.join(TARGET_DIR, "video", METADATA_ONLY_DIR, VIDEO_OUTTMPL),
+			}
+		if args.max_filesize:
+			ydl_opts["max_filesize"] = args.max_filesize * 2**20
+		_ydl = ydl_sessions.enter_context(yt_dlp.YoutubeDL(ydl_opts))
+	return _ydl
+
+def downloaded_files(info):
+	"""The final paths of the files downloaded by yt-dlp for an info dict (also for playlists)."""
+	if info.get("entries"):
+		return [path for entry in info["entries"] if entry for path in downloaded_files(entry)]
+	paths = [d["filepath"] for d in info.get("requested_downloads", []) if d.get("filepath")]
+	if len(paths) == 0 and info.get("filepath"):
+		paths = [info["filepath"]]
+	return [path for path in paths if osp.isfile(path)]
 
 def download_instagram_video(url, id_str = ""):
-	ydl_opts = {
-		"overwrites" : False,
-		# "cookiesfrombrowser" : ('firefox', 'oi67r0nh.default-release', None),
-		"cookies" : COOKIES_FILE,
-		"outtmpl": osp.join(TARGET_DIR, "video", id_str + "%(id)s-%(upload_date>%Y-%m-%d-|)s%(title)s-%(timestamp)s_gdl.%(ext)s"),
-	}
-	with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-		ydl.download([url])
-		info = ydl.extract_info(url, download=False)
-		out_json = id_str + url_to_filename(url, ".json")
-		with open(osp.join(TARGET_DIR, "video", "metadata", out_json), 'w', encoding='utf-8') as f:
-			json.dump(ydl.sanitize_info(info), f, ensure_ascii=False, indent=4)
-					# lib.add_exif_metadata(out_json, TODO TARGET_DIR + "/video")
+	with ydl_lock:
+		wait_for_request_slot()
+		ydl = get_youtube_dl()
+		# A single extraction, used both for the download and for the metadata sidecar;
+		# the file names start with the takeout date of the URL (see VIDEO_OUTTMPL)
+		info = ydl.extract_info(url, download=True, extra_info={"takeout_date": id_str})
+		sanitized = ydl.sanitize_info(info)
+	files = downloaded_files(info)
+	out_json = osp.join(TARGET_DIR, "video", "metadata" if files else METADATA_ONLY_DIR, id_str + url_to_filename(url, ".json"))
+	with open(out_json, 'w', encoding='utf-8') as f:
+		json.dump(sanitized, f, ensure_ascii=False, indent=4)
+	tag_media(files, info, metadata_path = out_json)
 	print()
 	print()
 
-def load_done():
-	if not os.path.isfile(DONE_FILE):
-		return []
-	with open(DONE_FILE, "r") as f:
-		return json.load(f)
+# With --metadata-only the links go to a separate list, so that a later full run still downloads their media
+DONE_LIST = "metadata_done" if args.metadata_only else "done"
+done = state.get("done")
+if args.metadata_only:
+	done = done | state.get("metadata_done")
 
-done = load_done()
+# Optional EXIF tagging stage, fed directly by the downloaders (--tag)
+tagger = None
+tagger_lock = threading.Lock()
+
+def tag_media(media_paths, data, metadata_path = None):
+	"""
+	Hands the downloaded files to the tagger, if any. Tagging never fails a download:
+	if the tagger has stopped, it's dropped for the rest of the run (the files it missed
+	are tagged by lib.py), and the links are still marked as done.
+	"""
+	global tagger
+	current = tagger
+	if current is None:
+		return
+	try:
+		current.submit(media_paths, data, metadata_path = metadata_path)
+	except Exception as e:
+		with tagger_lock:
+			if tagger is current:
+				tagger = None
+				print(f"EXIF tagging stopped ({e}): the downloads go on, run lib.py to tag the remaining files")
 
 def add_url_to_done(url):
-	global done
-	done += [url]
-	with open(DONE_FILE, 'w', encoding='utf-8') as f:
-		json.dump(done, f, ensure_ascii=False, indent=4)
+	state.add(DONE_LIST, url)
 
+## Posts with gallery-dl, run in-process
+# https://github.com/mikf/gallery-dl
 
-n_videos_to_download = len(list(filter(lambda url : not url in done, video_links)))
+# %python3 -m pip install -U gallery-dl
+import logging
+from gallery_dl import config as gdl_config, job as gdl_job, output as gdl_output, cache as gdl_cache, exception as gdl_exception
+from gallery_dl.extractor.message import Message
 
-if n_videos_to_download > 0:
-	print("##################")
-	print(f"# Downloading {n_videos_to_download} video")
-	print("##################")
-
-	for i, url in enumerate(video_links):
-		if url in done:
-			continue
-		print(i+1, "/", len(video_links))
-		id_str = get_date_str(url) + "-"
+# gallery-dl keeps its configuration, logging, archive and cache in process-wide globals and is
+# not meant to run several jobs at once: its jobs are serialized, while the videos still download in parallel
+gallery_dl_lock = threading.Lock()
 
+def setup_gallery_dl():
+	"""
+	Configures gallery-dl once for the whole run, with the same options we used to pass on
+	the command line to a new `gallery-dl` process for each post:
+	  --cookies COOKIES_FILE --range 1- -d TARGET_DIR/post -f "<takeout date>{num}-..."
+	  -o extractor.facebook.videos="ytdl" -o extractor.instagram.archive=GALLERY_DL_DONE_FILE
+	  -o extractor.instagram.metadata=true --mtime date --sleep SLEEP_MIN-SLEEP_MAX --write-metadata
+	"""
+	gdl_config.load()
+	gdl_output.initialize_logging(logging.INFO)
+	logging.getLogger().addHandler(ThreadLogCapture(logging.WARNING))
+	gdl_config.set(("extractor",), "cookies", COOKIES_FILE)
+	gdl_config.set(("extractor",), "image-range", "1-")
+	gdl_config.set(("extractor",), "base-directory", osp.join(TARGET_DIR, "post"))
+	# No instagram/<user>/ subdirectories: the files go straight to TARGET_DIR/post
+	gdl_config.set(("extractor",), "directory", [])
+	# The takeout date depends on the URL: it's passed to each job as the `takeout_date` keyword
+	gdl_config.set(("extractor",), "filename", "{takeout_date}{num}-{shortcode}-{media_id}-{date:%Y-%m-%d_%H:%M:%S}-{username}.{extension}")
+	gdl_config.set(("extractor",), "sleep", [SLEEP_MIN, SLEEP_MAX])
+	gdl_config.set(("extractor", "facebook"), "videos", "ytdl")
+	gdl_config.set(("extractor", "instagram"), "archive", GALLERY_DL_DONE_FILE)
+	gdl_config.set(("extractor", "instagram"), "metadata", True)
+	gdl_config.set((), "postprocessors", [
+		{"name": "mtime"}, # key "date"
+		{"name": "metadata", "mode": "json"},
+	])
+	if args.max_filesize:
+		gdl_config.set(("downloader",), "filesize-max", f"{args.max_filesize}M")
+
+class TaggingDownloadJob(gdl_job.DownloadJob):
+	"""DownloadJob that hands each downloaded file, with its metadata, to the tagger."""
+	def handle_url(self, url, kwdict):
+		super().handle_url(url, kwdict)
+		path = self.pathfmt.realpath if self.pathfmt else None
+		if path and osp.isfile(path):
+			tag_media([path], kwdict)
+
+_thread_local = threading.local()
+
+class ThreadLogCapture(logging.Handler):
+	"""Collects the warnings and errors that gallery-dl logs in the current thread, to classify its failures."""
+	def emit(self, record):
+		records = getattr(_thread_local, "gallery_dl_records", None)
+		if records is not None:
+			records.append(record)
+
+class GalleryDlError(Exception):
+	"""
+	A failed gallery-dl job. Jobs don't raise: `status` is the bitmask of the errors returned by run(),
+	`errors` the exceptions it logged (e.g. HttpError, with its HTTP status), see classify_error.
+	"""
+	def __init__(self, message, status = 0, errors = ()):
+		super().__init__(message)
+		self.status = status
+		self.errors = list(errors)
+
+def logged_exceptions(records):
+	"""The exceptions attached to log records: gallery-dl logs them as arguments of the message."""
+	errors = []
+	for record in records:
+		args = record.args if isinstance(record.args, tuple) else ()
+		errors += [arg for arg in args if isinstance(arg, BaseException)]
+		if record.exc_info and record.exc_info[1] is not None:
+			errors.append(record.exc_info[1])
+	return errors
+
+def download_instagram_post(url, id_str = ""):
+	with gallery_dl_lock:
+		wait_for_request_slot()
+		job = (gdl_job.DownloadJob if tagger is None else TaggingDownloadJob)(url)
+		job.kwdict["takeout_date"] = id_str
+		_thread_local.gallery_dl_records = []
 		try:
-			download_instagram_video(url, id_str)
-			add_url_to_done(url)
-		except Exception as e:
-			print(f"An error occurred: {e}")
-		time.sleep(random.randint(SLEEP_MIN, SLEEP_MAX))
-
-
+			status = job.run()
+		finally:
+			records = _thread_local.gallery_dl_records
+			_thread_local.gallery_dl_records = None
+	messages = [record.getMessage() for record in records]
+	# 0: everything downloaded (or already in the archive); otherwise a bitmask of the errors
+	if status != 0:
+		# With --max-filesize, each file over the limit logs a size warning and then "Failed to download":
+		# the post is done only if all of its errors are of this kind
+		n_too_large = sum("larger than allowed maximum" in m for m in messages)
+		other_errors = [
+			record for record in records
+			if record.levelno >= logging.ERROR and not record.getMessage().startswith("Failed to download")
+		]
+		n_failed = sum(m.startswith("Failed to download") for m in messages)
+		if status == 4 and n_too_large > 0 and n_failed <= n_too_large and not other_errors and not logged_exceptions(records):
+			print(f"Skipped {n_too_large} files over {args.max_filesize} MB of {url}")
+			return
+		raise GalleryDlError(f"gallery-dl failed with status {status} on {url}: " + " | ".join(messages), status, logged_exceptions(records))
+
+def download_instagram_post_metadata(url, id_str = ""):
+	"""--metadata-only: extracts the post with a DataJob (no download) and saves its metadata json."""
+	with gallery_dl_lock:
+		wait_for_request_slot()
+		job = gdl_job.DataJob(url, file=io.StringIO())
+		job.run()
+	kwdicts = []
+	for entry in job.data:
+		if entry[0] == -1:
+			# DataJob doesn't raise nor log: the errors end up in its data, by exception name
+			error_class = getattr(gdl_exception, entry[1]["error"], None)
+			raise GalleryDlError(f"gallery-dl failed on {url}: {entry[1]['error']}: {entry[1]['message']}", getattr(error_class, "code", 0))
+		if entry[0] == Message.Url:
+			kwdicts.append(entry[-1])
+	if len(kwdicts) == 0:
+		raise Exception(f"gallery-dl found no media in {url}")
+	# The post-level fields (description, username, post_date, ...) are the same for all the files of a carousel
+	metadata = {key: value for key, value in kwdicts[0].items() if not key.startswith("_")}
+	out_json = osp.join(TARGET_DIR, "post", METADATA_ONLY_DIR, id_str + url_to_filename(url, ".json"))
+	with open(out_json, 'w', encoding='utf-8') as f:
+		json.dump(metadata, f, ensure_ascii=False, indent=4, default=str)
 
+	# %gallery-dl \
+	#   --cookies cookies.Facebook.txt \
+	#   --input-file TARGET_DIR/instagram_posts.txt \
+	#   --sleep 2-10 \
+	#   --range 1- \
+	#   -d "TARGET_DIR/post" \
+	#   -f "{num}_{shortcode}_{media_id}_{date:%Y-%m-%d_%H:%M:%S}_{username}.{extension}" \
+	#   -o extractor.instagram.metadata=true \
+	#   --write-metadata
 
-## Posts
-# https://github.com/mikf/gallery-dl
+# A single request budget for instagram.com, shared by all the workers:
+# on average one URL every (SLEEP_MIN + SLEEP_MAX) / 2 seconds, as with the old sleep after each download,
+# but a video and a post download at the same time
+bucket = lib.TokenBucket(rate = 2 / (SLEEP_MIN + SLEEP_MAX))
+# Opened by any worker that hits the rate limit: everybody pauses, instead of hammering a throttled endpoint
+breaker = lib.CircuitBreaker(RATE_LIMIT_PAUSE, RATE_LIMIT_MAX_PAUSE)
 
-# %python3 -m pip install -U gallery-dl
-import glob
+def wait_for_request_slot():
+	"""
+	Called by the downloaders once they hold their lock (ydl_lock, gallery_dl_lock), right before
+	the requests: a worker blocked on the lock doesn't keep a token, to spend as soon as it gets it.
+	"""
+	breaker.wait()
+	bucket.acquire()
 
-# Pulisce la cache
-lib.esegui("gallery-dl --clear-cache ALL", shell=True)
+# Fallback for the errors without a type or HTTP status to look at (see classify_error):
+# error messages of yt-dlp (DownloadError) and gallery-dl (log records, see ThreadLogCapture)
+RATE_LIMIT_ERRORS = re.compile(r"HTTP Error 429|\b429 Too Many Requests|rate[- ]limit|Please wait a few minutes", re.IGNORECASE)
+TRANSIENT_ERRORS = re.compile(r"HTTP Error 5\d\d|'5\d\d |\b5\d\d (Internal|Bad Gateway|Service Unavailable|Gateway)|timed out|Connection (reset|aborted|refused)", re.IGNORECASE)
+PERMANENT_ERRORS = re.compile(r"HTTP Error (400|404|410)|'(400|404|410) |\b(400 Bad Request|404 Not Found|410 Gone)|NotFoundError|could not be found", re.IGNORECASE)
 
-n_posts_to_download = len(list(filter(lambda url : not url in done, post_links)))
+# Bits of the status of a gallery-dl job for the errors that won't go away by retrying
+GALLERY_DL_PERMANENT_STATUS = gdl_exception.NotFoundError.code | gdl_exception.NoExtractorError.code
 
-if n_posts_to_download > 0:
+def error_chain(error):
+	"""
+	The error and the ones behind it: the original exception of a yt-dlp DownloadError (exc_info),
+	the cause of an ExtractorError, the exceptions logged by a gallery-dl job, __cause__ and __context__.
+	"""
+	chain = []
+	stack = [error]
+	while stack:
+		e = stack.pop(0)
+		if not isinstance(e, BaseException) or any(e is seen for seen in chain):
+			continue
+		chain.append(e)
+		exc_info = getattr(e, "exc_info", None)
+		if isinstance(exc_info, tuple) and len(exc_info) == 3:
+			stack.append(exc_info[1])
+		stack += [getattr(e, "cause", None), e.__cause__, e.__context__]
+		if isinstance(e, GalleryDlError):
+			stack += e.errors
+	return chain
+
+def http_status(error):
+	"""The HTTP status of an HTTP error of yt-dlp, gallery-dl, urllib or requests (None for the other errors)."""
+	for status in (getattr(error, "status", None), getattr(error, "code", None), getattr(getattr(error, "response", None), "status_code", None)):
+		if isinstance(status, int) and 100 <= status < 600:
+			return status
+	return None
+
+def classify_exception(error):
+	status = http_status(error)
+	if status == 429:
+		return "rate_limit"
+	if status is not None and (status >= 500 or status == 408):
+		return "transient"
+	if status in (400, 404, 410):
+		return "permanent"
+	if isinstance(error, (TimeoutError, ConnectionError)):
+		return "transient"
+	if isinstance(error, (gdl_exception.NotFoundError, gdl_exception.NoExtractorError)):
+		return "permanent"
+	if isinstance(error, GalleryDlError) and error.status & GALLERY_DL_PERMANENT_STATUS:
+		return "permanent"
+	return None
+
+def classify_error(error):
+	"""
+	'rate_limit', 'transient' (worth a retry), 'permanent' (to blacklist) or None (unknown).
+	The types and HTTP statuses of the exceptions behind the error decide, a rate limit or a transient
+	error winning over a permanent one; the messages are looked at only when they say nothing
+	(e.g. the file downloads of gallery-dl, which just log a line).
+	"""
+	kinds = set(classify_exception(e) for e in error_chain(error))
+	for kind in ("rate_limit", "transient", "permanent"):
+		if kind in kinds:
+			return kind
+	message = str(error)
+	if RATE_LIMIT_ERRORS.search(message):
+		return "rate_limit"
+	if TRANSIENT_ERRORS.search(message):
+		return "transient"
+	if PERMANENT_ERRORS.search(message):
+		return "permanent"
+	return None
+
+def run_downloads(jobs, n_workers = N_WORKERS):
+	"""
+	Downloads the (url, download function) jobs with n_workers threads, in order.
+	Failures are classified (see classify_error): permanent ones go to the blacklist,
+	transient ones back to the queue with exponential backoff, and rate limits also open
+	the circuit breaker. Unknown errors are just printed, as before.
+	"""
+	# Heap of (not before, order, attempt, url, download)
+	heap = [(0, i, 0, url, download) for i, (url, download) in enumerate(jobs)]
+	heapq.heapify(heap)
+	lock = threading.Lock()
+	# Jobs in the heap or in progress: a worker can exit only when there are no more retries to wait for
+	remaining = [len(jobs)]
+	order = itertools.count(len(jobs))
+	counter = itertools.count(1)
+
+	def retry(url, download, attempt, delay):
+		with lock:
+			heapq.heappush(heap, (time.monotonic() + delay, next(order), attempt + 1, url, download))
+
+	def worker():
+		while True:
+			with lock:
+				if remaining[0] == 0:
+					return
+				job = heapq.heappop(heap) if heap else None
+			if job is None:
+				# The other workers may still put some jobs back
+				time.sleep(1)
+				continue
+			not_before, _, attempt, url, download = job
+			time.sleep(max(0, not_before - time.monotonic()))
+			print(f"{next(counter)} / {len(jobs)}: {url}" + (f" (attempt {attempt + 1})" if attempt > 0 else ""))
+			finished = True
+			try:
+				download(url, get_date_str(url) + "-")
+				add_url_to_done(url)
+				breaker.reset()
+			except Exception as e:
+				print(f"An error occurred: {e}")
+				kind = classify_error(e)
+				if kind == "permanent":
+					print(f"Blacklisting {url}")
+					state.add("blacklist", url)
+				elif kind in ("rate_limit", "transient") and attempt + 1 < MAX_ATTEMPTS:
+					if kind == "rate_limit":
+						pause = breaker.trip()
+						if pause is not None:
+							print(f"Rate limited: pausing all downloads for {pause // 60} minutes")
+					delay = RETRY_DELAY * 2 ** attempt * random.uniform(1, 1.5)
+					print(f"Retrying {url} in {delay:.0f} seconds")
+					retry(url, download, attempt, delay)
+					finished = False
+				elif kind is not None:
+					print(f"Giving up on {url} after {attempt + 1} attempts")
+			if finished:
+				with lock:
+					remaining[0] -= 1
+
+	threads = [threading.Thread(target=worker, daemon=True) for _ in range(n_workers)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+
+
+## Reels and TVs with yt-dlp, posts with gallery-dl
+
+video_jobs = [(url, download_instagram_video) for url in video_links if not url in done]
+download_post = download_instagram_post_metadata if args.metadata_only else download_instagram_post
+post_jobs = [(url, download_post) for url in post_links if not url in done]
+
+if len(post_jobs) > 0:
+	setup_gallery_dl()
+	# Pulisce la cache
+	gdl_cache.clear("ALL")
+
+if len(video_jobs) + len(post_jobs) > 0:
 	print("##################")
-	print(f"# Downloading {n_posts_to_download} posts")
+	print(f"# Downloading {len(video_jobs)} video and {len(post_jobs)} posts")
 	print("##################")
 
-	# Scarica i media dai post
-	for i, url in enumerate(post_links):
-		if url in done:
-			continue
-		print(f"{i + 1} / {len(post_links)}")
-		id_str = get_date_str(url) + "-"
-		
-		cmd = f"""gallery-dl \
-		  --cookies {COOKIES_FILE} \
-		  {url} \
-		  --range 1- \
-		  -d {TARGET_DIR}/post \
-		  -f "{id_str}{{num}}-{{shortcode}}-{{media_id}}-{{date:%Y-%m-%d_%H:%M:%S}}-{{username}}.{{extension}}" \
-		  -o extractor.facebook.videos="ytdl" \
-		  -o extractor.instagram.archive="{GALLERY_DL_DONE_FILE}" \
-		  -o extractor.instagram.metadata=true \
-		  --mtime date \
-		  --sleep {SLEEP_MIN}-{SLEEP_MAX} \
-		  --write-metadata"""
+	# The two queues are interleaved, so that they drain in parallel
+	jobs = [job for pair in itertools.zip_longest(video_jobs, post_jobs) for job in pair if job is not None]
+	if args.tag:
+		tagger = lib.ExifTagger()
+	with ydl_sessions:
+		run_downloads(jobs)
 
+	if tagger is not None:
+		print("Waiting for the last EXIF writes...")
 		try:
-			lib.esegui(cmd, shell=True)
-			# filename = glob.glob(f"{TARGET_DIR}/{id_str}*.json")
-			# assert(len(filename) == 1)
-			# filename = filename[1]
-			# lib.add_exif_metadata(filename TODO, TARGET_DIR)
-			add_url_to_done(url)
+			for path, error in tagger.close():
+				print(f"EXIF failed: {path} ({error})")
 		except Exception as e:
-			print(f"An error occurred: {e}")
+			print(f"EXIF tagging stopped ({e}): run lib.py to tag the remaining files")
 
-	# %gallery-dl \
-	#   --cookies cookies.Facebook.txt \
-	#   --input-file TARGET_DIR/instagram_posts.txt \
-	#   --sleep 2-10 \
-	#   --range 1- \
-	#   -d "TARGET_DIR/post" \
-	#   -f "{num}_{shortcode}_{media_id}_{date:%Y-%m-%d_%H:%M:%S}_{username}.{extension}" \
-	#   -o extractor.instagram.metadata=true \
-	#   --write-metadata
+# Clean up post directory
 
-	# Clean up post directory
-
-	def move_and_cleanup_directory(source_base, dest_base):
-	    try:
-	        # Ensure the destination directory exists
-	        os.makedirs(dest_base, exist_ok=True)
-
-	        # Iterate over each subdirectory in the source base directory
-	        for root, dirs, files in os.walk(source_base):
-	            for file in files:
-	                # Construct the full file path
-	                source_file_path = os.path.join(root, file)
-	                # Construct the destination file path
-	                dest_file_path = os.path.join(dest_base, file)
-
-	                # Check for filename conflicts
-	                if os.path.exists(dest_file_path):
-	                    print(f"Conflict detected: {dest_file_path} already exists.")
-	                    response = input("Do you want to skip, overwrite, or stop? [skip/overwrite/stop]: ").strip().lower()
-	                    if response == 'skip':
-	                        print(f"Skipping: {source_file_path}")
-	                        continue
-	                    elif response == 'overwrite':
-	                        print(f"Overwriting: {dest_file_path}")
-	                    elif response == 'stop':
-	                        print("Operation stopped by user.")
-	                        return
-	                    else:
-	                        print("Invalid option. Skipping file.")
-	                        continue
-
-	                # Move the file
-	                shutil.move(source_file_path, dest_file_path)
-	                print(f"Moved: {source_file_path} to {dest_file_path}")
-
-	        # Remove the source base directory and all its contents
-	        shutil.rmtree(source_base)
-	        print(f"Removed directory: {source_base}")
-
-	    except Exception as e:
-	        print(f"An error occurred: {e}")
-
-	# Define the paths
-	source_directory = TARGET_DIR + '/post/instagram'
-	dest_directory = TARGET_DIR + '/post'
-
-	# Execute the function
+def file_digest(path):
+	h = hashlib.sha1()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1 << 20), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+def same_content(path_a, path_b):
+	return osp.getsize(path_a) == osp.getsize(path_b) and file_digest(path_a) == file_digest(path_b)
+
+def move_and_cleanup_directory(source_base, dest_base):
+	"""
+	Moves every file under source_base directly into dest_base (atomic renames, same filesystem),
+	then removes source_base. Never asks: on a name conflict, a file with the same content
+	(size + hash) is dropped, a different one gets a suffix with its hash (`name-<hash>.ext`),
+	so that the result doesn't depend on the order or on how many times we run.
+	"""
+	try:
+		os.makedirs(dest_base, exist_ok=True)
+		moved, skipped, renamed = 0, 0, 0
+		for root, dirs, files in os.walk(source_base):
+			for file in files:
+				source_file_path = osp.join(root, file)
+				dest_file_path = osp.join(dest_base, file)
+				if osp.exists(dest_file_path):
+					if same_content(source_file_path, dest_file_path):
+						os.remove(source_file_path)
+						skipped += 1
+						continue
+					stem, ext = osp.splitext(file)
+					dest_file_path = osp.join(dest_base, f"{stem}-{file_digest(source_file_path)[:12]}{ext}")
+					if osp.exists(dest_file_path) and same_content(source_file_path, dest_file_path):
+						os.remove(source_file_path)
+						skipped += 1
+						continue
+					print(f"Conflict: {osp.join(dest_base, file)} already exists, renaming to {dest_file_path}")
+					renamed += 1
+				os.replace(source_file_path, dest_file_path)
+				moved += 1
+
+		shutil.rmtree(source_base)
+		print(f"Moved {moved} files ({renamed} renamed), skipped {skipped} duplicates; removed directory: {source_base}")
+
+	except Exception as e:
+		print(f"An error occurred: {e}")
+
+# Files left in gallery-dl's default directories (post/instagram/<user>/) by older runs
+source_directory = TARGET_DIR + '/post/instagram'
+dest_directory = TARGET_DIR + '/post'
+if osp.isdir(source_directory):
 	move_and_cleanup_directory(source_directory, dest_directory)
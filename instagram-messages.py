@@ -3,15 +3,35 @@
 import os
 import os.path
 import json
+import sqlite3
+import hashlib
+import argparse
+import threading
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from datetime import datetime
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import shutil
 from pathlib import Path
 from tqdm import tqdm  # Optional, for progress bars
 
+# Optional (Unix only): reflinks with the FICLONE ioctl
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# Optional: Parquet export of messages and threads (see --parquet)
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
 
 # Load environment variables from .env file
 load_dotenv()
@@ -23,6 +43,10 @@ INSTAGRAM_BASE_DIR = Path(os.getenv('INSTAGRAM_BASE_DIR'))
 INPUT_DIR = INSTAGRAM_BASE_DIR / Path("your_instagram_activity/messages/inbox")
 OUTPUT_DIR = Path(os.path.join(os.getenv('TARGET_DIR', './takeout-downloaded'), "instagram-messages"))
 MESSAGES_CHUNK_SIZE = 10000  # How many messages per JSONL chunk
+LINK_MODE = "copy"  # How attachments get into OUTPUT_DIR: "copy", "hardlink" or "reflink" (see --link-mode)
+IO_THREADS = 8  # Attachments transferred in parallel, while the JSON files are processed
+MAX_PENDING_MESSAGES = 1000  # Messages of a thread kept in memory while their attachments are transferred
+FICLONE = 0x40049409  # From linux/fs.h
 
 # Create output directories
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -31,17 +55,73 @@ OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 (OUTPUT_DIR / "media/photos").mkdir(parents=True, exist_ok=True)
 (OUTPUT_DIR / "media/videos").mkdir(parents=True, exist_ok=True)
 
-# Store all threads metadata here
-threads_metadata = []
-# Store all messages here before chunking
-all_messages = []
+def set_media_options(link_mode: str, io_threads: int):
+	"""Set LINK_MODE and IO_THREADS (also in the worker processes, as Pool initializer)."""
+	global LINK_MODE, IO_THREADS
+	LINK_MODE = link_mode
+	IO_THREADS = io_threads
 
-# Counter for global messages index
-global_message_index = 0
-
-# Crawl input directory
-thread_folders = [f for f in INPUT_DIR.iterdir() if f.is_dir()]
-print(f"Found {len(thread_folders)} threads.")
+def reflink_or_copy(src_path: Path, dst_path: Path):
+	"""
+	Clone src_path into dst_path sharing its data blocks (FICLONE, on btrfs, xfs, ...).
+	Where that's not supported, fall back to copy_file_range (an in-kernel copy, itself
+	a reflink on some filesystems) and finally to a plain copy.
+	"""
+	with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+		if fcntl is not None:
+			try:
+				fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+				return
+			except OSError:
+				pass
+		if hasattr(os, "copy_file_range"):
+			try:
+				remaining = os.fstat(src.fileno()).st_size
+				while remaining > 0:
+					copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+					if copied == 0:
+						break
+					remaining -= copied
+				if remaining == 0:
+					return
+			except OSError:
+				pass
+		src.seek(0)
+		dst.seek(0)
+		dst.truncate()
+		shutil.copyfileobj(src, dst)
+
+def transfer_media(src_path: Path, dst_path: Path) -> bool:
+	"""
+	Put src_path in dst_path according to LINK_MODE. The file is prepared under a temporary
+	name in the same directory and then renamed over dst_path: an interrupted run never leaves
+	a partial attachment, and an existing dst_path (e.g. a hardlink to the takeout file, left by
+	a previous --link-mode hardlink run) is replaced, never written into.
+	Hardlinks across filesystems are not possible: those files are copied.
+	Returns True if dst_path is a hardlink to src_path, i.e. it is the takeout file itself.
+	"""
+	if LINK_MODE == "hardlink" and dst_path.exists() and os.path.samefile(src_path, dst_path):
+		return True
+	tmp_path = dst_path.with_name(f".{dst_path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+	try:
+		linked = False
+		if LINK_MODE == "hardlink":
+			try:
+				os.link(src_path, tmp_path)
+				linked = True
+			except OSError:
+				pass
+		if not linked:
+			if LINK_MODE == "reflink":
+				reflink_or_copy(src_path, tmp_path)
+				shutil.copystat(src_path, tmp_path)
+			else:
+				shutil.copy2(src_path, tmp_path)
+		os.replace(tmp_path, dst_path)
+		return linked
+	finally:
+		if os.path.lexists(tmp_path):
+			os.remove(tmp_path)
 
 def copy_and_rename_media(
 	src_path: Path,
@@ -52,7 +132,8 @@ def copy_and_rename_media(
 ) -> str:
 	"""
 	Copy a media file and rename it to include thread, sender, and timestamp.
-	Also set the file's modification time to the message timestamp.
+	Also set the file's modification time to the message timestamp, except for
+	hardlinks: they share the inode with the takeout file, which is left untouched.
 	Returns the relative path of the copied file.
 	"""
 	if not src_path.exists():
@@ -62,23 +143,176 @@ def copy_and_rename_media(
 	dst_path = dst_dir / new_filename
 
 	try:
-		# Copy the file (preserves original metadata as much as possible)
-		shutil.copy2(src_path, dst_path)
+		# Copy (or link) the file (preserves original metadata as much as possible)
+		if not transfer_media(src_path, dst_path):
+			# Convert ISO timestamp to POSIX timestamp
+			# ISO example: "2023-06-27T15:30:00"
+			dt = datetime.fromisoformat(timestamp_iso)
+			posix_timestamp = dt.timestamp()
 
-		# Convert ISO timestamp to POSIX timestamp
-		# ISO example: "2023-06-27T15:30:00"
-		dt = datetime.fromisoformat(timestamp_iso)
-		posix_timestamp = dt.timestamp()
-
-		# Set access and modified times
-		os.utime(dst_path, (posix_timestamp, posix_timestamp))
+			# Set access and modified times
+			os.utime(dst_path, (posix_timestamp, posix_timestamp))
 
 		return str(dst_path.relative_to(OUTPUT_DIR))
 	except Exception as e:
 		print(f"Warning: failed to copy {src_path} -> {dst_path} ({e})")
 		return None
 
-for thread_folder in tqdm(thread_folders, desc="Processing threads"):
+# Thread pool for the attachment transfers, one per process,
+# and the slots limiting the transfers submitted and not finished yet
+_io_pool = None
+_io_slots = None
+
+def submit_media(*args):
+	"""
+	Like copy_and_rename_media, but in the I/O thread pool: returns a Future of the relative path.
+	Blocks while 4 * IO_THREADS transfers are already queued or running.
+	"""
+	global _io_pool, _io_slots
+	if _io_pool is None:
+		_io_pool = ThreadPoolExecutor(max_workers=IO_THREADS)
+		_io_slots = threading.BoundedSemaphore(4 * IO_THREADS)
+	_io_slots.acquire()
+	future = _io_pool.submit(copy_and_rename_media, *args)
+	future.add_done_callback(lambda _: _io_slots.release())
+	return future
+
+class ChunkedJsonlWriter:
+	"""
+	Write records to rolling `messages_part_NNNN.jsonl` files of chunk_size lines each,
+	as soon as they are produced, instead of keeping them all in memory.
+	The files are the same we'd get by slicing the list of all the records into chunks.
+	With start > 0, it appends to an existing export of start records (see --incremental):
+	the last chunk is completed before opening new ones.
+	"""
+	def __init__(self, directory: Path, chunk_size: int = MESSAGES_CHUNK_SIZE, prefix: str = "messages_part", start: int = 0):
+		self.directory = directory
+		self.chunk_size = chunk_size
+		self.prefix = prefix
+		self.count = start  # Records written so far
+		self.chunk_index = start // chunk_size  # Chunk files opened so far
+		self.file = None
+		if start % chunk_size != 0:
+			# Reopen the last chunk, dropping any line written after the last saved state (e.g. by a crashed run)
+			chunk_path = self.directory / f"{self.prefix}_{self.chunk_index:04d}.jsonl"
+			with open(chunk_path, "r", encoding="utf-8") as f:
+				lines = [line for _, line in zip(range(start % chunk_size), f)]
+				truncated = f.read(1) != ""
+			if len(lines) != start % chunk_size:
+				raise Exception(f"{chunk_path} has fewer messages than expected: the export is not consistent with its state")
+			if truncated:
+				# Through a temporary file, so that a crash here doesn't lose the messages already exported
+				tmp_path = chunk_path.with_name(f"{chunk_path.name}.tmp")
+				with open(tmp_path, "w", encoding="utf-8") as f:
+					f.writelines(lines)
+				os.replace(tmp_path, chunk_path)
+			self.file = open(chunk_path, "a", encoding="utf-8")
+			self.chunk_index += 1
+
+	def write(self, record: dict):
+		if self.count % self.chunk_size == 0:
+			self.close()
+			chunk_path = self.directory / f"{self.prefix}_{self.chunk_index:04d}.jsonl"
+			self.file = open(chunk_path, "w", encoding="utf-8")
+			self.chunk_index += 1
+		self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+		self.count += 1
+
+	def flush(self):
+		if self.file is not None:
+			self.file.flush()
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+class ExportState:
+	"""
+	State of the export, saved next to it in OUTPUT_DIR, for --incremental runs:
+	the fingerprint and metadata of each thread, the dedup keys of the messages
+	already exported and their total (i.e. the next global_index).
+	"""
+	def __init__(self, path: Path):
+		self.conn = sqlite3.connect(str(path))
+		self.conn.executescript("""
+			CREATE TABLE IF NOT EXISTS threads (folder TEXT PRIMARY KEY, position INTEGER, fingerprint TEXT, metadata TEXT);
+			CREATE TABLE IF NOT EXISTS messages (folder TEXT, key TEXT, PRIMARY KEY (folder, key)) WITHOUT ROWID;
+			CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER);
+		""")
+
+	def reset(self):
+		with self.conn:
+			self.conn.execute("DELETE FROM threads")
+			self.conn.execute("DELETE FROM messages")
+			self.conn.execute("DELETE FROM counters")
+
+	def total_messages(self) -> int:
+		row = self.conn.execute("SELECT value FROM counters WHERE name = 'total_messages'").fetchone()
+		return 0 if row is None else row[0]
+
+	def fingerprint(self, folder: str):
+		row = self.conn.execute("SELECT fingerprint FROM threads WHERE folder = ?", (folder,)).fetchone()
+		return None if row is None else row[0]
+
+	def thread_metadata(self, folder: str):
+		row = self.conn.execute("SELECT metadata FROM threads WHERE folder = ?", (folder,)).fetchone()
+		return None if row is None else json.loads(row[0])
+
+	def threads_metadata(self) -> list:
+		"""The metadata of all the threads, in the order they were first exported."""
+		return [json.loads(metadata) for (metadata,) in self.conn.execute("SELECT metadata FROM threads ORDER BY position")]
+
+	def message_keys(self, folder: str) -> set:
+		return set(key for (key,) in self.conn.execute("SELECT key FROM messages WHERE folder = ?", (folder,)))
+
+	def update_thread(self, folder: str, fingerprint: str, metadata: dict, keys: list, total_messages: int):
+		"""Save a processed thread; call it after its messages have been written (and flushed)."""
+		with self.conn:
+			row = self.conn.execute("SELECT position FROM threads WHERE folder = ?", (folder,)).fetchone()
+			position = row[0] if row is not None else self.conn.execute("SELECT COUNT(*) FROM threads").fetchone()[0]
+			self.conn.execute("INSERT OR REPLACE INTO threads VALUES (?, ?, ?, ?)", (folder, position, fingerprint, json.dumps(metadata, ensure_ascii=False)))
+			self.conn.executemany("INSERT OR IGNORE INTO messages VALUES (?, ?)", [(folder, key) for key in keys])
+			self.conn.execute("INSERT OR REPLACE INTO counters VALUES ('total_messages', ?)", (total_messages,))
+
+	def close(self):
+		self.conn.close()
+
+def thread_fingerprint(thread_folder: Path) -> str:
+	"""Hash of the names and contents of the message_X.json files of a thread."""
+	h = hashlib.sha1()
+	for message_file in sorted(thread_folder.glob("message_*.json")):
+		h.update(message_file.name.encode("utf-8") + b"\0")
+		h.update(message_file.read_bytes())
+	return h.hexdigest()
+
+def message_key(m: dict) -> str:
+	"""Dedup key of a raw message: timestamp_ms, sender and a hash of its content (text, attachments, shared link)."""
+	content = [m.get("content"), m.get("share", {}).get("link")]
+	for kind in ("audio_files", "photos", "videos"):
+		content += [os.path.basename(entry["uri"]) for entry in m.get(kind, [])]
+	content_hash = hashlib.sha1(json.dumps(content, ensure_ascii=False).encode("utf-8")).hexdigest()
+	return f"{m.get('timestamp_ms')}\t{m.get('sender_name')}\t{content_hash}"
+
+def process_thread(thread_folder: Path, known_keys: set = None, first_index: int = 0, emit = None):
+	"""
+	Read all the message files of a thread folder and copy its media.
+	Returns the thread metadata, the normalized message records, their dedup keys
+	and the fingerprint of the thread. The records have no global_index: that is
+	assigned in the merge step (see main), so threads can be processed in parallel
+	and still give the same output of a serial run.
+	With emit, each record is passed to it, in order, as soon as its attachments are done,
+	and the returned list is empty: the messages of the thread are never all in memory.
+	With known_keys (--incremental), the messages already exported are skipped,
+	and the new ones are numbered in the thread from first_index (the message_count of
+	the previous export). Without it, index_in_thread is the position in the message files.
+	"""
 	# Load thread metadata from the first message file
 	first_msg_file = next(thread_folder.glob("message_*.json"))
 	with open(first_msg_file, "r", encoding="utf-8") as f:
@@ -100,12 +334,28 @@ for thread_folder in tqdm(thread_folders, desc="Processing threads"):
 	# Process all message_X.json files
 	message_files = sorted(thread_folder.glob("message_*.json"))
 	messages_in_thread = []
+	if emit is None:
+		emit = messages_in_thread.append
+	# Records still waiting for their attachments, emitted in order
+	pending = collections.deque()
+	n_messages = 0
+	message_keys = []
+	if known_keys is not None:
+		known_keys = set(known_keys)
+	fingerprint = hashlib.sha1()  # Same as thread_fingerprint
 
 	for message_file in message_files:
-		with open(message_file, "r", encoding="utf-8") as f:
-			data = json.load(f)
+		raw = message_file.read_bytes()
+		fingerprint.update(message_file.name.encode("utf-8") + b"\0")
+		fingerprint.update(raw)
+		data = json.loads(raw.decode("utf-8"))
 
 		for m in data.get("messages", []):
+			key = message_key(m)
+			if known_keys is not None:
+				if key in known_keys:
+					continue
+				known_keys.add(key)
 			timestamp_ms = m.get("timestamp_ms")
 			timestamp_iso = datetime.utcfromtimestamp(timestamp_ms / 1000).isoformat() + "Z"
 			sender = m.get("sender_name")
@@ -122,27 +372,21 @@ for thread_folder in tqdm(thread_folders, desc="Processing threads"):
 				for audio_entry in m["audio_files"]:
 					audio_file = audio_entry["uri"]
 					src = INSTAGRAM_BASE_DIR / audio_file
-					relative_path = copy_and_rename_media(src, OUTPUT_DIR / "media/audio", thread_folder.name, sender, timestamp_iso)
-					if relative_path:
-						audio_paths.append(relative_path)
+					audio_paths.append(submit_media(src, OUTPUT_DIR / "media/audio", thread_folder.name, sender, timestamp_iso))
 
 			# Copy photos
 			if "photos" in m:
 				for photo_entry in m["photos"]:
 					photo_file = photo_entry["uri"]
 					src = INSTAGRAM_BASE_DIR / photo_file
-					relative_path = copy_and_rename_media(src, OUTPUT_DIR / "media/photos", thread_folder.name, sender, timestamp_iso)
-					if relative_path:
-						photo_paths.append(relative_path)
+					photo_paths.append(submit_media(src, OUTPUT_DIR / "media/photos", thread_folder.name, sender, timestamp_iso))
 
 			# Copy videos
 			if "videos" in m:
 				for video_entry in m["videos"]:
 					video_file = video_entry["uri"]
 					src = INSTAGRAM_BASE_DIR / video_file
-					relative_path = copy_and_rename_media(src, OUTPUT_DIR / "media/videos", thread_folder.name, sender, timestamp_iso)
-					if relative_path:
-						video_paths.append(relative_path)
+					video_paths.append(submit_media(src, OUTPUT_DIR / "media/videos", thread_folder.name, sender, timestamp_iso))
 
 			# Collect shared links
 			if "share" in m and "link" in m["share"]:
@@ -159,8 +403,8 @@ for thread_folder in tqdm(thread_folders, desc="Processing threads"):
 			# Build normalized message record
 			record = {
 				"thread_id": thread_id,
-				"index_in_thread": len(messages_in_thread),
-				"global_index": global_message_index,
+				"index_in_thread": first_index + n_messages,
+				"global_index": None,  # Assigned in the merge step
 				"timestamp": timestamp_iso,
 				"sender": sender,
 				"text": text,
@@ -173,47 +417,206 @@ for thread_folder in tqdm(thread_folders, desc="Processing threads"):
 				"sentiment": None
 			}
 
-			messages_in_thread.append(record)
-			all_messages.append(record)
-			global_message_index += 1
+			pending.append(record)
+			n_messages += 1
+			message_keys.append(key)
+			if len(pending) > MAX_PENDING_MESSAGES:
+				emit(complete_record(pending.popleft()))
+
+	while pending:
+		emit(complete_record(pending.popleft()))
 
 	# Update thread metadata with message count
-	thread_metadata["message_count"] = len(messages_in_thread)
-	threads_metadata.append(thread_metadata)
-
-print("Done processing threads. Splitting messages into chunks...")
-
-# Write messages chunked JSONL files
-chunk_index = 0
-for i in range(0, len(all_messages), MESSAGES_CHUNK_SIZE):
-	chunk = all_messages[i:i+MESSAGES_CHUNK_SIZE]
-	chunk_path = OUTPUT_DIR / "messages" / f"messages_part_{chunk_index:04d}.jsonl"
-	with open(chunk_path, "w", encoding="utf-8") as f:
-		for record in chunk:
-			f.write(json.dumps(record, ensure_ascii=False) + "\n")
-	chunk_index += 1
-
-print(f"Stored {chunk_index} message files.")
-
-# Write threads.jsonl
-threads_jsonl_path = OUTPUT_DIR / "threads.jsonl"
-with open(threads_jsonl_path, "w", encoding="utf-8") as f:
-	for t in threads_metadata:
-		f.write(json.dumps(t, ensure_ascii=False) + "\n")
-
-# Write metadata.json
-metadata = {
-	"export_date": datetime.utcnow().isoformat() + "Z",
-	"processed_by": "instagram-messages.py",
-	"total_threads": len(threads_metadata),
-	"total_messages": len(all_messages)
-}
-metadata_path = OUTPUT_DIR / "metadata.json"
-with open(metadata_path, "w", encoding="utf-8") as f:
-	json.dump(metadata, f, indent=2)
-
-shutil.copy2("instagram-messages.md", OUTPUT_DIR / "README.md")
-
-print("README.md copied")
-
-print(f"All done! Export ready in {OUTPUT_DIR}")
+	thread_metadata["message_count"] = first_index + n_messages
+	return thread_metadata, messages_in_thread, message_keys, fingerprint.hexdigest()
+
+def complete_record(record: dict) -> dict:
+	"""Wait for the attachments of a record, dropping the ones that failed."""
+	for key in ("audio", "photos", "videos"):
+		record[key] = [relative_path for relative_path in (future.result() for future in record[key]) if relative_path]
+	return record
+
+def _process_thread_job(job):
+	return process_thread(*job)
+
+def imap_bounded(pool, func, jobs: list, window: int):
+	"""
+	Like pool.imap, but with at most window jobs submitted and not consumed yet: the workers
+	don't run ahead of the merge step, and their results don't pile up in memory.
+	"""
+	jobs = iter(jobs)
+	pending = collections.deque()
+	for job in jobs:
+		pending.append(pool.apply_async(func, (job,)))
+		if len(pending) >= window:
+			yield pending.popleft().get()
+	while pending:
+		yield pending.popleft().get()
+
+def iso_to_ms(timestamp_iso: str) -> int:
+	"""Inverse of the conversion in process_thread: "2023-06-27T15:30:00.123000Z" -> milliseconds since the epoch."""
+	return round((datetime.fromisoformat(timestamp_iso.rstrip("Z")) - datetime(1970, 1, 1)) / timedelta(milliseconds=1))
+
+def table_from_records(records: list, schema) -> "pa.Table":
+	"""Build a table with the given schema; dictionary columns are encoded from plain strings."""
+	arrays = []
+	for field in schema:
+		values = [record.get(field.name) for record in records]
+		if pa.types.is_dictionary(field.type):
+			arrays.append(pa.array(values, pa.string()).dictionary_encode())
+		else:
+			arrays.append(pa.array(values, field.type))
+	return pa.Table.from_arrays(arrays, schema=schema)
+
+def write_parquet(output_dir: Path, n_chunks: int, threads_metadata: list):
+	"""
+	Write the export also as a Parquet dataset in output_dir/parquet, reading back the JSONL chunks
+	one at a time: messages partitioned by year (messages/year=YYYY/part-0.parquet, one row group
+	per chunk and year) and threads.parquet. thread_id and sender are dictionary-encoded, and the
+	ISO timestamp becomes timestamp_ms (int64, milliseconds since the epoch, UTC).
+	"""
+	dictionary_string = pa.dictionary(pa.int32(), pa.string())
+	messages_schema = pa.schema([
+		("thread_id", dictionary_string),
+		("index_in_thread", pa.int64()),
+		("global_index", pa.int64()),
+		("timestamp_ms", pa.int64()),
+		("sender", dictionary_string),
+		("text", pa.string()),
+		("audio", pa.list_(pa.string())),
+		("photos", pa.list_(pa.string())),
+		("videos", pa.list_(pa.string())),
+		("shared_link", pa.string()),
+		("reactions", pa.list_(pa.struct([("actor", pa.string()), ("reaction", pa.string())]))),
+		("language", pa.string()),
+		("sentiment", pa.string()),
+	])
+	threads_schema = pa.schema([
+		("thread_id", pa.string()),
+		("title", pa.string()),
+		("participants", pa.list_(pa.string())),
+		("is_still_participant", pa.bool_()),
+		("message_count", pa.int64()),
+	])
+
+	parquet_dir = output_dir / "parquet"
+	shutil.rmtree(parquet_dir, ignore_errors=True)
+	writers = {}
+	try:
+		for chunk_index in tqdm(range(n_chunks), desc="Writing Parquet"):
+			records_by_year = {}
+			with open(output_dir / "messages" / f"messages_part_{chunk_index:04d}.jsonl", "r", encoding="utf-8") as f:
+				for line in f:
+					record = json.loads(line)
+					record["timestamp_ms"] = iso_to_ms(record["timestamp"])
+					records_by_year.setdefault(record["timestamp"][:4], []).append(record)
+			for year, records in sorted(records_by_year.items()):
+				if year not in writers:
+					year_dir = parquet_dir / "messages" / f"year={year}"
+					year_dir.mkdir(parents=True, exist_ok=True)
+					writers[year] = pq.ParquetWriter(str(year_dir / "part-0.parquet"), messages_schema)
+				writers[year].write_table(table_from_records(records, messages_schema))
+	finally:
+		for writer in writers.values():
+			writer.close()
+
+	parquet_dir.mkdir(parents=True, exist_ok=True)
+	pq.write_table(table_from_records(threads_metadata, threads_schema), str(parquet_dir / "threads.parquet"))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Export the Instagram messages of a takeout to chunked JSONL files.")
+	parser.add_argument("--workers", type=int, default=1, help="number of processes handling the threads in parallel")
+	parser.add_argument("--link-mode", choices=["copy", "hardlink", "reflink"], default=LINK_MODE, help="how to export the attachments: full copies, hardlinks to the takeout files, or reflinks (copy-on-write clones, falling back to copies)")
+	parser.add_argument("--io-threads", type=int, default=IO_THREADS, help="attachments transferred in parallel (per process)")
+	parser.add_argument("--incremental", action="store_true", help="update the previous export: skip the unchanged threads, append only the new messages")
+	parser.add_argument("--parquet", action="store_true", help="also write the messages and threads as a Parquet dataset (needs pyarrow)")
+	args = parser.parse_args()
+	if args.parquet and pa is None:
+		parser.error("--parquet needs pyarrow (pip install pyarrow)")
+	set_media_options(args.link_mode, args.io_threads)
+
+	# Crawl input directory
+	thread_folders = [f for f in INPUT_DIR.iterdir() if f.is_dir()]
+	print(f"Found {len(thread_folders)} threads.")
+
+	# The state of the export is always saved, so that the next run can be --incremental
+	state = ExportState(OUTPUT_DIR / "export-state.sqlite3")
+	if not args.incremental:
+		state.reset()
+
+	# Worker processes for the threads (see imap_bounded)
+	pool = multiprocessing.Pool(args.workers, initializer=set_media_options, initargs=(args.link_mode, args.io_threads)) if args.workers > 1 else None
+
+	if args.incremental:
+		# Only the new or changed threads, with the keys of the messages already exported
+		fingerprints = pool.imap(thread_fingerprint, thread_folders) if pool is not None else map(thread_fingerprint, thread_folders)
+		jobs = []
+		for thread_folder, fingerprint in zip(thread_folders, fingerprints):
+			if state.fingerprint(thread_folder.name) == fingerprint:
+				continue
+			previous = state.thread_metadata(thread_folder.name)
+			jobs.append((thread_folder, state.message_keys(thread_folder.name), previous["message_count"] if previous else 0))
+		print(f"{len(jobs)} new or changed threads.")
+	else:
+		jobs = [(thread_folder, None, 0) for thread_folder in thread_folders]
+
+	# Messages are written in chunked JSONL files while the threads are processed
+	# (the messages already exported keep their global index)
+	messages_writer = ChunkedJsonlWriter(OUTPUT_DIR / "messages", start=state.total_messages())
+
+	def write_message(record: dict):
+		# Merge step: global indices and chunk boundaries depend only on the order of the threads
+		record["global_index"] = messages_writer.count
+		messages_writer.write(record)
+
+	if pool is not None:
+		# Threads are processed in parallel, a few at a time, and merged in order
+		results = imap_bounded(pool, _process_thread_job, jobs, 2 * args.workers)
+	else:
+		# Serially, the messages go straight to the writer
+		results = (process_thread(*job, emit=write_message) for job in jobs)
+
+	for job, (thread_metadata, messages_in_thread, message_keys, fingerprint) in zip(jobs, tqdm(results, total=len(jobs), desc="Processing threads")):
+		for record in messages_in_thread:
+			write_message(record)
+		messages_writer.flush()
+		state.update_thread(job[0].name, fingerprint, thread_metadata, message_keys, messages_writer.count)
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+	messages_writer.close()
+	print("Done processing threads.")
+	print(f"Stored {messages_writer.chunk_index} message files.")
+
+	# Store all threads metadata here
+	threads_metadata = state.threads_metadata()
+	state.close()
+
+	# Write threads.jsonl
+	threads_jsonl_path = OUTPUT_DIR / "threads.jsonl"
+	with open(threads_jsonl_path, "w", encoding="utf-8") as f:
+		for t in threads_metadata:
+			f.write(json.dumps(t, ensure_ascii=False) + "\n")
+
+	# Write the Parquet dataset
+	if args.parquet:
+		write_parquet(OUTPUT_DIR, messages_writer.chunk_index, threads_metadata)
+		print(f"Parquet dataset written in {OUTPUT_DIR / 'parquet'}")
+
+	# Write metadata.json
+	metadata = {
+		"export_date": datetime.utcnow().isoformat() + "Z",
+		"processed_by": "instagram-messages.py",
+		"total_threads": len(threads_metadata),
+		"total_messages": messages_writer.count
+	}
+	metadata_path = OUTPUT_DIR / "metadata.json"
+	with open(metadata_path, "w", encoding="utf-8") as f:
+		json.dump(metadata, f, indent=2)
+
+	shutil.copy2("instagram-messages.md", OUTPUT_DIR / "README.md")
+
+	print("README.md copied")
+
+	print(f"All done! Export ready in {OUTPUT_DIR}")
@@ -1,13 +1,44 @@
 import os
+import re
 import sys
 import json
+import time
+import queue
+import shutil
+import bisect
+import tempfile
+import hashlib
+import sqlite3
+import threading
 import subprocess
+import multiprocessing
+from multiprocessing import util as multiprocessing_util
 from datetime import datetime
 
 from exiftool import ExifToolHelper
+from exiftool.exceptions import ExifToolExecuteError
+
+# Opzionale: parsing json molto più veloce per i json (anche di vari MB) scritti da yt-dlp
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+import config
 
 TARGET_DIR = os.path.join(os.getenv('TARGET_DIR', 'takeout-downloaded'), "instagram-saved")
 
+# Numero di file scritti con un singolo round trip verso exiftool (0 = un file alla volta)
+EXIF_BATCH_SIZE = int(os.getenv('EXIF_BATCH_SIZE', '200'))
+EXIF_WRITE_PARAMS = ["-P", "-overwrite_original"]
+# Scrive JPEG e MP4 direttamente da Python (vedi write_exif_native), usando exiftool per il resto
+EXIF_NATIVE = os.getenv('EXIF_NATIVE', '1') == '1'
+# Legge i tag prima di scriverli, e scrive con exiftool solo quelli diversi (vedi diff_exif_tags)
+EXIF_DIFF = os.getenv('EXIF_DIFF', '1') == '1'
+EXIF_TAG_NAMES = ["Title", "Author", "CreateDate", "ModifyDate", "DateTimeOriginal", "Keywords"]
+EXIF_DATE_TAGS = ("CreateDate", "ModifyDate", "DateTimeOriginal")
+EXIF_MANIFEST_FILE = config.CACHE_DIR / "exif-manifest.sqlite3"
+
 import subprocess
 
 def esegui(cmd, **kwargs):
@@ -18,13 +49,149 @@ def esegui(cmd, **kwargs):
 		raise Exception("Process returned " + str(result))
 
 
+class StateStore:
+	"""
+	Liste persistenti di URL (done, blacklist, ...) su SQLite.
+	L'appartenenza si controlla su un set in memoria (O(1)); ogni aggiunta è una transazione
+	a sé (journal WAL), quindi un crash non corrompe lo stato né perde gli URL già registrati.
+	Si può usare da più thread.
+	"""
+	def __init__(self, path):
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(str(path), check_same_thread=False)
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS urls (list TEXT, url TEXT, added TEXT, PRIMARY KEY (list, url)) WITHOUT ROWID")
+		# Per le liste ricavate da un file (vedi sync): la firma del file da cui sono state lette
+		self.conn.execute("CREATE TABLE IF NOT EXISTS signatures (list TEXT PRIMARY KEY, signature TEXT)")
+		self.conn.commit()
+		self.sets = {}
+
+	def get(self, name):
+		"""Il set degli URL della lista name (da non modificare direttamente: usare add/remove)."""
+		with self.lock:
+			if name not in self.sets:
+				self.sets[name] = set(url for (url,) in self.conn.execute("SELECT url FROM urls WHERE list = ?", (name,)))
+			return self.sets[name]
+
+	def contains(self, name, url):
+		return url in self.get(name)
+
+	def add(self, name, url):
+		urls = self.get(name)
+		with self.lock:
+			if url in urls:
+				return
+			with self.conn:
+				self.conn.execute("INSERT OR IGNORE INTO urls VALUES (?, ?, ?)", (name, url, datetime.now().isoformat()))
+			urls.add(url)
+
+	def remove(self, name, url):
+		urls = self.get(name)
+		with self.lock:
+			with self.conn:
+				self.conn.execute("DELETE FROM urls WHERE list = ? AND url = ?", (name, url))
+			urls.discard(url)
+
+	def sync(self, name, signature, load_urls):
+		"""
+		Sostituisce la lista name con gli URL restituiti da load_urls(), ma solo se signature
+		(es. dimensione e mtime del file da cui vengono) è cambiata dall'ultima volta.
+		Restituisce il set degli URL, come get.
+		"""
+		with self.lock:
+			row = self.conn.execute("SELECT signature FROM signatures WHERE list = ?", (name,)).fetchone()
+		if row is not None and row[0] == signature:
+			return self.get(name)
+		urls = set(load_urls())
+		now = datetime.now().isoformat()
+		with self.lock:
+			with self.conn:
+				self.conn.execute("DELETE FROM urls WHERE list = ?", (name,))
+				self.conn.executemany("INSERT INTO urls VALUES (?, ?, ?)", [(name, url, now) for url in urls])
+				self.conn.execute("INSERT OR REPLACE INTO signatures VALUES (?, ?)", (name, signature))
+			self.sets[name] = urls
+		return urls
+
+	def migrate_json(self, name, json_path):
+		"""Importa una vecchia lista json (es. instagram-done.json) e la rinomina in .migrated."""
+		if not os.path.isfile(json_path):
+			return
+		with open(json_path, "r") as f:
+			urls = json.load(f)
+		now = datetime.now().isoformat()
+		with self.lock:
+			with self.conn:
+				self.conn.executemany("INSERT OR IGNORE INTO urls VALUES (?, ?, ?)", [(name, url, now) for url in urls])
+			self.sets.pop(name, None)
+		os.replace(json_path, str(json_path) + ".migrated")
+		print(f"Migrated {len(urls)} URLs from {json_path} to the '{name}' list.")
+
+class TokenBucket:
+	"""
+	Token bucket condiviso tra thread: in media al più rate richieste al secondo,
+	con burst fino a capacity. acquire() blocca finché non c'è un token disponibile.
+	"""
+	def __init__(self, rate, capacity = 1):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.last = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+				self.last = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+class CircuitBreaker:
+	"""
+	Interruttore condiviso tra thread, per fermare tutti i worker quando si raggiunge il rate limit.
+	trip() lo apre per cooldown secondi, raddoppiati a ogni apertura consecutiva (fino a max_cooldown);
+	wait() blocca finché è aperto; reset(), dopo un successo, riporta il cooldown al valore iniziale.
+	"""
+	def __init__(self, cooldown, max_cooldown):
+		self.cooldown = cooldown
+		self.max_cooldown = max_cooldown
+		self.trips = 0
+		self.open_until = 0
+		self.lock = threading.Lock()
+
+	def trip(self):
+		"""Apre l'interruttore e restituisce la pausa; None se era già aperto (es. da un altro worker)."""
+		with self.lock:
+			now = time.monotonic()
+			if now < self.open_until:
+				return None
+			delay = min(self.cooldown * 2 ** self.trips, self.max_cooldown)
+			self.trips += 1
+			self.open_until = now + delay
+			return delay
+
+	def reset(self):
+		with self.lock:
+			self.trips = 0
+
+	def wait(self):
+		while True:
+			with self.lock:
+				remaining = self.open_until - time.monotonic()
+			if remaining <= 0:
+				return
+			time.sleep(remaining)
+
 def escape(s):
 	a = s.encode(encoding='ascii', errors='backslashreplace').decode("ascii", "ignore")
 	# print(a)
 	return a
 
-def write_exif(et, image_path, title=None, author=None, post_date=None, keywords=None, silent = False):
-	now = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+def build_exif_tags(title=None, author=None, post_date=None, keywords=None):
 	tags = {}
 	if title:
 		tags["Title"] = escape(title)
@@ -43,6 +210,435 @@ def write_exif(et, image_path, title=None, author=None, post_date=None, keywords
 	if keywords:
 		tags["Keywords"] = ", ".join(list(map(lambda x : escape(x), keywords)))
 
+	return tags
+
+def set_file_times(image_path, post_date):
+	if post_date:
+		unshare_file(image_path)
+		# Modifica il filesystem modification/access time
+		dt = datetime.strptime(post_date, '%Y-%m-%d %H:%M:%S')
+		timestamp = dt.timestamp()
+		os.utime(image_path, (timestamp, timestamp))
+
+def _normalize_tag_value(tag, value):
+	if isinstance(value, list):
+		value = ", ".join(map(str, value))
+	value = str(value)
+	if tag in EXIF_DATE_TAGS:
+		# '2021:05:06 07:08:09+02:00' e '2021-05-06 07:08:09' sono la stessa data
+		return re.sub(r"[^0-9]", "", value)[:14]
+	return value
+
+def diff_exif_tags(tags, current):
+	"""
+	Restituisce i tag di tags (vedi build_exif_tags) il cui valore è diverso da quello attuale.
+	current è il dizionario restituito da get_tags per il file, con chiavi tipo 'XMP:Title':
+	basta che uno dei gruppi contenga già il valore giusto.
+	"""
+	current_values = {}
+	for key, value in current.items():
+		tag = key.split(":")[-1]
+		current_values.setdefault(tag, set()).add(_normalize_tag_value(tag, value))
+	return {
+		tag: value for tag, value in tags.items()
+		if _normalize_tag_value(tag, value) not in current_values.get(tag, set())
+	}
+
+def read_exif_tags(et, image_paths):
+	"""Legge con un solo round trip i tag di EXIF_TAG_NAMES dei file dati; None se la lettura fallisce."""
+	try:
+		current = et.get_tags(image_paths, tags = EXIF_TAG_NAMES)
+	except Exception:
+		return None
+	if len(current) != len(image_paths):
+		return None
+	return current
+
+# Writer nativo (senza exiftool) per JPEG e MP4.
+# Scrive gli stessi tag di build_exif_tags in un pacchetto XMP; x:xmptk identifica i pacchetti
+# scritti da qui, gli unici che possiamo sostituire senza perdere altri metadati.
+# Nei JPEG le date e le Keywords vanno anche in EXIF e IPTC, dove le scrive exiftool: i segmenti
+# nostri si riconoscono da Software (EXIF) e OriginatingProgram (IPTC) uguali a XMP_TOOLKIT.
+XMP_TOOLKIT = "bitsofus"
+XMP_PADDING = 2400
+JPEG_XMP_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+JPEG_EXIF_HEADER = b"Exif\x00\x00"
+JPEG_IPTC_HEADER = b"Photoshop 3.0\x00"
+EXIF_OWN_MARKER = XMP_TOOLKIT.encode("ascii") + b"\x00"
+IPTC_OWN_MARKER = b"\x1c\x02\x41" + len(XMP_TOOLKIT).to_bytes(2, "big") + XMP_TOOLKIT.encode("ascii")
+# exiftool tronca IPTC:Keywords alla lunghezza massima della specifica
+IPTC_KEYWORDS_MAX = 64
+MP4_XMP_UUID = bytes.fromhex("be7acfcb97a942e89c71999491e3afac")
+MP4_EPOCH = datetime(1904, 1, 1)
+
+def _xml_escape(s):
+	return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+def build_xmp_packet(tags, size = None):
+	"""
+	Pacchetto XMP con i tag di build_exif_tags (Title, Author, date e Keywords).
+	Il padding finale permette le riscritture successive sul posto; con size il pacchetto
+	viene allungato esattamente a size byte (None se non ci sta).
+	"""
+	props = []
+	if "Title" in tags:
+		props.append(f'<dc:title><rdf:Alt><rdf:li xml:lang="x-default">{_xml_escape(tags["Title"])}</rdf:li></rdf:Alt></dc:title>')
+	if "Author" in tags:
+		props.append(f'<pdf:Author>{_xml_escape(tags["Author"])}</pdf:Author>')
+	for tag, prop in (("CreateDate", "xmp:CreateDate"), ("ModifyDate", "xmp:ModifyDate"), ("DateTimeOriginal", "exif:DateTimeOriginal")):
+		if tag in tags:
+			props.append(f'<{prop}>{_xml_escape(tags[tag].replace(" ", "T"))}</{prop}>')
+	if "Keywords" in tags:
+		props.append(f'<pdf:Keywords>{_xml_escape(tags["Keywords"])}</pdf:Keywords>')
+	body = (
+		'<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+		f'<x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="{XMP_TOOLKIT}">\n'
+		'<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+		'<rdf:Description rdf:about=""'
+		' xmlns:dc="http://purl.org/dc/elements/1.1/"'
+		' xmlns:xmp="http://ns.adobe.com/xap/1.0/"'
+		' xmlns:exif="http://ns.adobe.com/exif/1.0/"'
+		' xmlns:pdf="http://ns.adobe.com/pdf/1.3/">\n'
+		+ "".join(p + "\n" for p in props) +
+		'</rdf:Description>\n'
+		'</rdf:RDF>\n'
+		'</x:xmpmeta>\n'
+	).encode("utf-8")
+	trailer = b'<?xpacket end="w"?>'
+	if size is None:
+		size = len(body) + XMP_PADDING + len(trailer)
+	n_padding = size - len(body) - len(trailer)
+	if n_padding < 0:
+		return None
+	padding = bytearray(b" " * n_padding)
+	# Una riga ogni 100 caratteri, come da specifica XMP
+	for i in range(99, n_padding, 100):
+		padding[i] = ord("\n")
+	return body + bytes(padding) + trailer
+
+def _is_own_xmp(packet):
+	return f'x:xmptk="{XMP_TOOLKIT}"'.encode("ascii") in packet[:512]
+
+def _rewrite_file(path, edits):
+	"""
+	Applica a un file le modifiche edits, tuple (offset, byte da rimuovere, byte da inserire) in ordine
+	di offset, scrivendo un file temporaneo accanto all'originale che poi lo sostituisce.
+	"""
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+	try:
+		with os.fdopen(fd, 'wb') as dst, open(path, 'rb') as src:
+			position = 0
+			for offset, remove_len, insert in edits:
+				dst.write(src.read(offset - position))
+				dst.write(insert)
+				src.seek(offset + remove_len)
+				position = offset + remove_len
+			shutil.copyfileobj(src, dst)
+		shutil.copymode(path, tmp_path)
+		os.replace(tmp_path, path)
+	finally:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+
+def unshare_file(path):
+	"""
+	Se il file ha altri hardlink (vedi instagram-duplicates.py --hardlink), lo sostituisce con una
+	sua copia con le stesse date, così le scritture sul posto e le date di un post non finiscono
+	anche negli altri file. exiftool non ne ha bisogno: scrive sempre un file nuovo.
+	"""
+	st = os.stat(path)
+	if st.st_nlink > 1:
+		_rewrite_file(path, [])
+		os.utime(path, ns = (st.st_atime_ns, st.st_mtime_ns))
+
+def _jpeg_segment(marker, payload):
+	if len(payload) + 2 > 0xFFFF:
+		raise Exception("Metadata too large for a JPEG segment")
+	return bytes([0xFF, marker]) + (len(payload) + 2).to_bytes(2, "big") + payload
+
+def _tiff_ascii(tag_id, value):
+	value = value.encode("ascii") + b"\x00"
+	return (tag_id, 2, len(value), value)
+
+def _tiff_ifd(entries, offset):
+	"""
+	IFD TIFF big-endian che inizia a offset: entries sono tuple (tag, tipo, count, valore in byte),
+	e i valori più lunghi di 4 byte vanno subito dopo la IFD.
+	"""
+	data_offset = offset + 2 + 12 * len(entries) + 4
+	ifd = bytearray(len(entries).to_bytes(2, "big"))
+	data = bytearray()
+	for tag_id, value_type, count, value in sorted(entries):
+		ifd += tag_id.to_bytes(2, "big") + value_type.to_bytes(2, "big") + count.to_bytes(4, "big")
+		if len(value) <= 4:
+			ifd += value.ljust(4, b"\x00")
+		else:
+			ifd += (data_offset + len(data)).to_bytes(4, "big")
+			data += value
+			if len(data) % 2 == 1:
+				data += b"\x00"
+	ifd += bytes(4)
+	return bytes(ifd + data)
+
+def build_exif_segment(tags):
+	"""
+	Segmento APP1 Exif con le date di build_exif_tags dove le scrive exiftool: ModifyDate in IFD0,
+	DateTimeOriginal e CreateDate nella sub-IFD Exif. None se tra i tag non ci sono date.
+	"""
+	if not any(tag in tags for tag in EXIF_DATE_TAGS):
+		return None
+	ifd0 = [_tiff_ascii(0x0131, XMP_TOOLKIT)]
+	if "ModifyDate" in tags:
+		ifd0.append(_tiff_ascii(0x0132, tags["ModifyDate"].replace("-", ":")))
+	exif_ifd = [
+		_tiff_ascii(tag_id, tags[tag].replace("-", ":"))
+		for tag, tag_id in (("DateTimeOriginal", 0x9003), ("CreateDate", 0x9004))
+		if tag in tags
+	]
+	if exif_ifd:
+		# La sub-IFD Exif va subito dopo IFD0, la cui lunghezza non dipende dal valore del puntatore
+		ifd0.append((0x8769, 4, 1, bytes(4)))
+		ifd0[-1] = (0x8769, 4, 1, (8 + len(_tiff_ifd(ifd0, 8))).to_bytes(4, "big"))
+	tiff = b"MM\x00\x2a" + (8).to_bytes(4, "big") + _tiff_ifd(ifd0, 8)
+	if exif_ifd:
+		tiff += _tiff_ifd(exif_ifd, len(tiff))
+	return _jpeg_segment(0xE1, JPEG_EXIF_HEADER + tiff)
+
+def build_iptc_segment(tags):
+	"""
+	Segmento APP13 (Photoshop IRB) con le Keywords in IPTC, come le scrive exiftool:
+	un solo valore, troncato a IPTC_KEYWORDS_MAX byte. None se tra i tag non ci sono Keywords.
+	"""
+	if "Keywords" not in tags:
+		return None
+	iptc = b""
+	for dataset, value in ((0, (4).to_bytes(2, "big")), (25, tags["Keywords"].encode("ascii")[:IPTC_KEYWORDS_MAX]), (65, XMP_TOOLKIT.encode("ascii"))):
+		iptc += b"\x1c\x02" + bytes([dataset]) + len(value).to_bytes(2, "big") + value
+	# Risorsa 0x0404 (IPTC-NAA) con nome vuoto; i dati sono allineati a 2 byte
+	resource = b"8BIM" + (0x0404).to_bytes(2, "big") + bytes(2) + len(iptc).to_bytes(4, "big") + iptc
+	if len(iptc) % 2 == 1:
+		resource += b"\x00"
+	return _jpeg_segment(0xED, JPEG_IPTC_HEADER + resource)
+
+def write_jpeg_metadata(path, tags):
+	"""
+	Scrive i tag in un JPEG negli stessi gruppi di exiftool: le date in EXIF, le Keywords in IPTC
+	e Title e Author in XMP (dove finiscono, per chi legge solo XMP, anche date e Keywords).
+	I segmenti già nostri vengono riscritti sul posto se la dimensione non cambia (le date hanno
+	lunghezza fissa e l'XMP ha del padding), altrimenti il file viene riscritto una volta sola.
+	Restituisce False se il file contiene metadati non nostri da aggiornare (meglio lasciarlo a exiftool).
+	"""
+	segments = {"exif": build_exif_segment(tags), "xmp": None, "iptc": build_iptc_segment(tags)}
+	with open(path, 'r+b') as f:
+		if f.read(2) != b"\xff\xd8":
+			raise Exception("Not a JPEG file")
+		# L'Exif va subito dopo SOI (o JFIF), XMP e IPTC dopo gli eventuali segmenti JFIF (APP0) ed Exif (APP1) iniziali
+		exif_at = 2
+		insert_at = 2
+		in_header = True
+		existing = {}
+		while True:
+			offset = f.tell()
+			marker = f.read(2)
+			if len(marker) < 2 or marker[0] != 0xFF:
+				raise Exception("Malformed JPEG segment")
+			# SOS: da qui iniziano i dati compressi; EOI: file finito
+			if marker[1] in (0xDA, 0xD9):
+				break
+			length = int.from_bytes(f.read(2), "big")
+			if length < 2:
+				raise Exception("Malformed JPEG segment length")
+			payload = f.read(length - 2)
+			kind = None
+			if marker[1] == 0xE1 and payload.startswith(JPEG_EXIF_HEADER):
+				kind = "exif"
+			elif marker[1] == 0xE1 and payload.startswith(JPEG_XMP_HEADER):
+				kind = "xmp"
+			elif marker[1] == 0xED and payload.startswith(JPEG_IPTC_HEADER):
+				kind = "iptc"
+			if kind is not None and kind not in existing:
+				existing[kind] = (offset, 2 + length, payload)
+			if offset == 2 and marker[1] == 0xE0:
+				exif_at = offset + 2 + length
+			if in_header and marker[1] in (0xE0, 0xE1):
+				insert_at = offset + 2 + length
+			else:
+				in_header = False
+
+		if "exif" in existing and segments["exif"] is not None and EXIF_OWN_MARKER not in existing["exif"][2]:
+			return False
+		if "iptc" in existing and segments["iptc"] is not None and IPTC_OWN_MARKER not in existing["iptc"][2]:
+			return False
+		packet = None
+		if "xmp" in existing:
+			old_packet = existing["xmp"][2][len(JPEG_XMP_HEADER):]
+			if not _is_own_xmp(old_packet):
+				return False
+			packet = build_xmp_packet(tags, size = len(old_packet))
+		if packet is None:
+			packet = build_xmp_packet(tags)
+		segments["xmp"] = _jpeg_segment(0xE1, JPEG_XMP_HEADER + packet)
+
+		edits = []
+		for kind in ("exif", "xmp", "iptc"):
+			if segments[kind] is None:
+				continue
+			if kind in existing:
+				offset, segment_len, _ = existing[kind]
+				edits.append((offset, segment_len, segments[kind]))
+			else:
+				edits.append((exif_at if kind == "exif" else insert_at, 0, segments[kind]))
+		# sort è stabile: allo stesso offset resta l'ordine Exif, XMP, IPTC
+		edits.sort(key = lambda edit: edit[0])
+		if all(len(insert) == remove_len for _, remove_len, insert in edits):
+			for offset, _, insert in edits:
+				f.seek(offset)
+				f.write(insert)
+			return True
+	_rewrite_file(path, edits)
+	return True
+
+def _mp4_boxes(f, start, end):
+	"""Elenca i box MP4 tra start ed end come tuple (tipo, offset, dimensione, dimensione dell'header)."""
+	boxes = []
+	offset = start
+	while offset + 8 <= end:
+		f.seek(offset)
+		header = f.read(8)
+		size = int.from_bytes(header[:4], "big")
+		box_type = header[4:8]
+		header_size = 8
+		if size == 1:
+			size = int.from_bytes(f.read(8), "big")
+			header_size = 16
+		elif size == 0:
+			size = end - offset
+		if size < header_size or offset + size > end:
+			raise Exception("Malformed MP4 box")
+		boxes.append((box_type, offset, size, header_size))
+		offset += size
+	if offset != end:
+		raise Exception("Malformed MP4 file")
+	return boxes
+
+def write_mp4_metadata(path, tags):
+	"""
+	Scrive i tag in un MP4 senza copiarlo: CreateDate e ModifyDate vanno nel box moov/mvhd,
+	modificato sul posto come fa exiftool; gli altri in un box uuid XMP in fondo al file, mentre
+	exiftool li scriverebbe negli atom QuickTime (per diff_exif_tags sono comunque equivalenti).
+	Restituisce False se il file non si può aggiornare così (ci pensa exiftool).
+	"""
+	with open(path, 'r+b') as f:
+		file_size = os.fstat(f.fileno()).st_size
+		boxes = _mp4_boxes(f, 0, file_size)
+		if len(boxes) == 0 or boxes[0][0] != b"ftyp":
+			raise Exception("Not an MP4 file")
+		moov = [b for b in boxes if b[0] == b"moov"]
+		if len(moov) != 1:
+			return False
+		f.seek(boxes[-1][1])
+		if int.from_bytes(f.read(4), "big") == 0:
+			# L'ultimo box arriva fino a fine file: non si può accodare niente
+			return False
+
+		mvhd = None
+		_, moov_offset, moov_size, moov_header = moov[0]
+		for box_type, offset, size, header_size in _mp4_boxes(f, moov_offset + moov_header, moov_offset + moov_size):
+			if box_type == b"mvhd":
+				mvhd = offset + header_size
+		if mvhd is None:
+			return False
+
+		xmp_box = None
+		for box_type, offset, size, header_size in boxes:
+			if box_type == b"uuid":
+				f.seek(offset + header_size)
+				if f.read(16) == MP4_XMP_UUID:
+					xmp_box = (offset, size, header_size)
+		if xmp_box is not None:
+			offset, size, header_size = xmp_box
+			f.seek(offset + header_size + 16)
+			if not _is_own_xmp(f.read(size - header_size - 16)):
+				return False
+
+		# Date nel movie header: secondi dal 1904, a 32 bit (versione 0) o 64 bit (versione 1)
+		f.seek(mvhd)
+		version = f.read(1)[0]
+		field_size = 8 if version == 1 else 4
+		for tag, field in (("CreateDate", 0), ("ModifyDate", 1)):
+			if tag in tags:
+				dt = datetime.strptime(tags[tag], '%Y-%m-%d %H:%M:%S')
+				seconds = int((dt - MP4_EPOCH).total_seconds())
+				f.seek(mvhd + 4 + field * field_size)
+				f.write(seconds.to_bytes(field_size, "big"))
+
+		if xmp_box is not None:
+			offset, size, header_size = xmp_box
+			packet = build_xmp_packet(tags, size = size - header_size - 16)
+			if packet is not None:
+				f.seek(offset + header_size + 16)
+				f.write(packet)
+				return True
+			if offset + size == file_size:
+				f.truncate(offset)
+				file_size = offset
+			else:
+				# Il vecchio box diventa spazio libero
+				f.seek(offset + 4)
+				f.write(b"free")
+
+		packet = build_xmp_packet(tags)
+		f.seek(file_size)
+		f.write((8 + 16 + len(packet)).to_bytes(4, "big") + b"uuid" + MP4_XMP_UUID + packet)
+	return True
+
+def xmp_sidecar_path(image_path):
+	# <file>.<ext>.xmp: i media di un carosello hanno lo stesso nome con estensioni diverse
+	return image_path + ".xmp"
+
+def write_xmp_sidecar(image_path, tags, post_date = None):
+	"""
+	Scrive i tag in un sidecar XMP accanto al media, lasciando intatto l'originale.
+	Il sidecar prende le stesse date del media (vedi set_file_times).
+	"""
+	sidecar_path = xmp_sidecar_path(image_path)
+	if os.path.exists(sidecar_path):
+		with open(sidecar_path, 'rb') as f:
+			if not _is_own_xmp(f.read()):
+				raise Exception(f"{sidecar_path} was not written by {XMP_TOOLKIT}, not overwriting it")
+	with open(sidecar_path + ".tmp", 'wb') as f:
+		f.write(build_xmp_packet(tags))
+	os.replace(sidecar_path + ".tmp", sidecar_path)
+	set_file_times(sidecar_path, post_date)
+
+def _try_write_exif_native(image_path, tags):
+	try:
+		unshare_file(image_path)
+		# Come -P di exiftool: il file mantiene le sue date (set_file_times poi mette quella del post, se c'è)
+		st = os.stat(image_path)
+		try:
+			return write_exif_native(image_path, tags)
+		finally:
+			os.utime(image_path, ns = (st.st_atime_ns, st.st_mtime_ns))
+	except Exception:
+		# Formato non riconosciuto o file malformato
+		return False
+
+def write_exif_native(image_path, tags):
+	"""
+	Fast path senza exiftool per JPEG e MP4. Restituisce False per gli altri formati;
+	in caso di errore solleva un'eccezione. In entrambi i casi si ripiega su exiftool.
+	"""
+	ext = os.path.splitext(image_path)[1].lower()
+	if ext in (".jpg", ".jpeg"):
+		return write_jpeg_metadata(image_path, tags)
+	if ext in (".mp4", ".m4v", ".mov"):
+		return write_mp4_metadata(image_path, tags)
+	return False
+
+def write_exif(et, image_path, title=None, author=None, post_date=None, keywords=None, silent = False, native = EXIF_NATIVE, diff = EXIF_DIFF, sidecar = False):
+	tags = build_exif_tags(title, author, post_date, keywords)
+
 	if not silent:
 		print("Setting:")
 		print(image_path)
@@ -52,22 +648,157 @@ def write_exif(et, image_path, title=None, author=None, post_date=None, keywords
 	error = None
 
 	try:
-		et.set_tags(
-			image_path,
-			tags=tags,
-			params=["-P", "-overwrite_original"]
-		)
+		if sidecar:
+			write_xmp_sidecar(image_path, tags, post_date)
+		elif not (native and tags and _try_write_exif_native(image_path, tags)):
+			if diff:
+				current = read_exif_tags(et, [image_path])
+				if current is not None:
+					tags = diff_exif_tags(tags, current[0])
+			if tags:
+				et.set_tags(
+					image_path,
+					tags=tags,
+					params=EXIF_WRITE_PARAMS
+				)
 	except Exception as e:
 	 	error = e
 	
-	if post_date:
-		# Modifica il filesystem modification/access time
-		dt = datetime.strptime(post_date, '%Y-%m-%d %H:%M:%S')
-		timestamp = dt.timestamp()
-		os.utime(image_path, (timestamp, timestamp))
+	set_file_times(image_path, post_date)
 	if error is not None:
 		raise(error)
 
+def execute_batch(et, commands):
+	"""
+	Esegue più comandi exiftool con un solo round trip, separandoli con -execute.
+	Restituisce l'output (stdout) di ciascun comando, nello stesso ordine.
+	"""
+	args = []
+	for i, command in enumerate(commands):
+		if i > 0:
+			args.append("-execute")
+		args.extend(command)
+	try:
+		stdout = et.execute(*args)
+	except ExifToolExecuteError as e:
+		# Lo status riguarda solo l'ultimo comando: l'output degli altri è comunque valido
+		stdout = e.stdout
+	# In modalità stay_open exiftool stampa "{ready}" dopo ogni -execute intermedio
+	outputs = stdout.split("{ready}")
+	if len(outputs) != len(commands):
+		raise Exception(f"Unexpected exiftool output for a batch of {len(commands)} commands")
+	return outputs
+
+def write_exif_batch(et, items, silent = False, native = EXIF_NATIVE, diff = EXIF_DIFF, sidecar = False):
+	"""
+	Come write_exif, ma scrive i metadati di molti file con un solo round trip verso exiftool.
+	Con diff, i tag attuali vengono prima letti con un'unica get_tags: si scrivono solo
+	quelli diversi, e i file già a posto non vengono riscritti affatto.
+	Con sidecar, i tag vanno in sidecar XMP (vedi write_xmp_sidecar) e exiftool non serve.
+	Ogni elemento di items è un dizionario con gli argomenti di write_exif
+	(image_path, title, author, post_date, keywords).
+	Restituisce una lista allineata a items con None o l'errore del singolo file.
+	"""
+	errors = [None] * len(items)
+	to_write = []
+	for i, item in enumerate(items):
+		tags = build_exif_tags(item.get("title"), item.get("author"), item.get("post_date"), item.get("keywords"))
+		if not silent:
+			print("Setting:")
+			print(item["image_path"])
+			print(tags)
+			print()
+		if not tags:
+			continue
+		if sidecar:
+			try:
+				write_xmp_sidecar(item["image_path"], tags, item.get("post_date"))
+			except Exception as e:
+				errors[i] = e
+			continue
+		if native and _try_write_exif_native(item["image_path"], tags):
+			continue
+		to_write.append((i, tags))
+
+	if diff and len(to_write) > 0:
+		current = read_exif_tags(et, [items[i]["image_path"] for i, _ in to_write])
+		if current is not None:
+			to_write = [(i, diff_exif_tags(tags, c)) for (i, tags), c in zip(to_write, current)]
+
+	commands = []
+	commanded_items = []
+	for i, tags in to_write:
+		if not tags:
+			continue
+		commands.append(
+			EXIF_WRITE_PARAMS
+			+ [f"-{tag}={value}" for tag, value in tags.items()]
+			+ [items[i]["image_path"]]
+		)
+		commanded_items.append(i)
+
+	if len(commands) > 0:
+		try:
+			outputs = execute_batch(et, commands)
+		except Exception as e:
+			outputs = [None] * len(commands)
+			batch_error = e
+		for i, output in zip(commanded_items, outputs):
+			if output is None:
+				errors[i] = batch_error
+			elif not re.search(r"\b1 image files (updated|unchanged)", output):
+				errors[i] = Exception(f"exiftool did not update the file: {output.strip()}")
+
+	for i, item in enumerate(items):
+		try:
+			set_file_times(item["image_path"], item.get("post_date"))
+		except Exception as e:
+			if errors[i] is None:
+				errors[i] = e
+	return errors
+
+def embed_xmp_sidecars(et, dir_path, batch_size = EXIF_BATCH_SIZE, remove = True):
+	"""
+	Passaggio successivo della modalità sidecar: copia nei media i tag dei sidecar XMP
+	scritti da write_xmp_sidecar (a blocchi, come write_exif_batch), poi rimuove i sidecar.
+	Restituisce la lista dei media falliti, con il relativo errore.
+	"""
+	names = set(os.listdir(dir_path))
+	pairs = [
+		(os.path.join(dir_path, name[:-len(".xmp")]), os.path.join(dir_path, name))
+		for name in sorted(names)
+		if name.endswith(".xmp") and name[:-len(".xmp")] in names
+	]
+	print(f"Found {len(pairs)} sidecars in {dir_path}.")
+	failures = []
+	for i in range(0, len(pairs), max(batch_size, 1)):
+		batch = pairs[i:i+max(batch_size, 1)]
+		commands = [
+			EXIF_WRITE_PARAMS + ["-tagsFromFile", sidecar_path] + [f"-{tag}" for tag in EXIF_TAG_NAMES] + [media_path]
+			for media_path, sidecar_path in batch
+		]
+		try:
+			outputs = execute_batch(et, commands)
+		except Exception as e:
+			outputs = [None] * len(commands)
+			failures += [(media_path, e) for media_path, _ in batch]
+		for (media_path, sidecar_path), output in zip(batch, outputs):
+			if output is None:
+				print("X", end="")
+			elif not re.search(r"\b1 image files (updated|unchanged)", output):
+				failures.append((media_path, Exception(f"exiftool did not update the file: {output.strip()}")))
+				print("X", end="")
+			else:
+				if remove:
+					with open(sidecar_path, 'rb') as f:
+						own = _is_own_xmp(f.read())
+					if own:
+						os.remove(sidecar_path)
+				print("-", end="")
+		sys.stdout.flush()
+	print()
+	return failures
+
 # def write_exif(image_path, title=None, author=None, post_date=None, tags=None):
 # 	cmd = ['exiftool', '-overwrite_original']
 # 	escape = lambda x : x.replace("'", "\\'")
@@ -116,6 +847,9 @@ def parse_metadata(data):
 		author = data.get("fullname")
 	if "timestamp" in data:
 		post_date = datetime.utcfromtimestamp(data.get("timestamp")).strftime('%Y-%m-%d %H:%M:%S')
+	elif isinstance(data.get("post_date"), datetime):
+		# Metadati presi direttamente da gallery-dl (kwdict), non ancora serializzati nel json
+		post_date = data["post_date"].strftime('%Y-%m-%d %H:%M:%S')
 	elif "post_date" in data:
 		# Già in formato stringa tipo "2017-11-06 21:33:22", converti in formato EXIF
 		try:
@@ -134,8 +868,141 @@ def parse_metadata(data):
 
 	return title, author, post_date, tags
 
+# Gli unici campi dei json usati da parse_metadata
+METADATA_FIELDS = ("description", "uploader", "fullname", "timestamp", "post_date", "tags")
+
+def _loads_json(raw):
+	if orjson is not None:
+		try:
+			return orjson.loads(raw)
+		except orjson.JSONDecodeError:
+			# orjson è più severo di json (NaN, surrogati spaiati...): riprova con quello
+			pass
+	return json.loads(raw)
+
+def extract_metadata_fields(raw):
+	"""Dal contenuto di un json di metadati (yt-dlp o gallery-dl) tiene solo i campi usati da parse_metadata."""
+	data = _loads_json(raw)
+	return {key: data[key] for key in METADATA_FIELDS if key in data}
+
+def load_metadata_fields(json_path):
+	"""
+	Legge un json di metadati e ne tiene solo i campi usati da parse_metadata,
+	scartando formats, thumbnails & co.
+	"""
+	with open(json_path, 'rb') as f:
+		return extract_metadata_fields(f.read())
+
+def build_media_index(dir_path):
+	"""
+	Indice dei media di una directory: la lista ordinata dei nomi dei file (esclusi json, sidecar
+	e file temporanei di _rewrite_file), su cui cercare per prefisso con find_media invece di
+	ripetere os.listdir per ogni json.
+	"""
+	return sorted(f for f in os.listdir(dir_path) if not f.endswith(('.json', '.xmp', '.tmp')))
+
+def find_media(media_index, prefix):
+	"""Restituisce i nomi in media_index che iniziano con prefix (ricerca binaria)."""
+	start = bisect.bisect_left(media_index, prefix)
+	end = start
+	while end < len(media_index) and media_index[end].startswith(prefix):
+		end += 1
+	return media_index[start:end]
+
+class ExifManifest:
+	"""
+	Manifest persistente dell'integrazione EXIF.
+	Per ogni media registra path, dimensione e mtime dopo la scrittura, insieme all'hash
+	del json da cui provengono i metadati: un media è da riscrivere solo se è cambiato
+	lui o il suo json. Con force=True considera tutto da riscrivere (ma continua ad aggiornarsi).
+	I media taggati con i sidecar XMP sono registrati a parte, per non confonderli con quelli
+	che hanno i tag incorporati.
+	"""
+	def __init__(self, path = EXIF_MANIFEST_FILE, force = False, sidecar = False):
+		self.force = force
+		self.mode = ":sidecar" if sidecar else ""
+		self.conn = sqlite3.connect(str(path))
+		self.conn.execute("CREATE TABLE IF NOT EXISTS media (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, json_hash TEXT)")
+		# Evita di ricalcolare l'hash dei json che non sono cambiati
+		self.conn.execute("CREATE TABLE IF NOT EXISTS json_files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)")
+		# Cache dei campi estratti da load_metadata_fields, per non riparsare json di vari MB
+		self.conn.execute("CREATE TABLE IF NOT EXISTS metadata_fields (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, fields TEXT)")
+
+	def _refresh_json(self, json_path, st):
+		"""
+		Legge un json nuovo o cambiato una volta sola, aggiornando sia il suo hash che i campi estratti.
+		Restituisce (hash, campi); i campi sono None se il json non è valido.
+		"""
+		with open(json_path, 'rb') as f:
+			raw = f.read()
+		h = hashlib.sha1(raw).hexdigest()
+		self.conn.execute("INSERT OR REPLACE INTO json_files VALUES (?, ?, ?, ?)", (json_path, st.st_size, st.st_mtime_ns, h))
+		try:
+			fields = extract_metadata_fields(raw)
+		except Exception:
+			return h, None
+		self.conn.execute("INSERT OR REPLACE INTO metadata_fields VALUES (?, ?, ?, ?)", (json_path, st.st_size, st.st_mtime_ns, json.dumps(fields, ensure_ascii=False)))
+		return h, fields
+
+	def json_hash(self, json_path):
+		json_path = os.path.abspath(json_path)
+		st = os.stat(json_path)
+		row = self.conn.execute("SELECT size, mtime_ns, hash FROM json_files WHERE path = ?", (json_path,)).fetchone()
+		if row is not None and row[:2] == (st.st_size, st.st_mtime_ns):
+			return row[2]
+		return self._refresh_json(json_path, st)[0]
+
+	def metadata_fields(self, json_path):
+		"""Come load_metadata_fields, ma usa la cache se il json non è cambiato."""
+		json_path = os.path.abspath(json_path)
+		st = os.stat(json_path)
+		row = self.conn.execute("SELECT size, mtime_ns, fields FROM metadata_fields WHERE path = ?", (json_path,)).fetchone()
+		if row is not None and row[:2] == (st.st_size, st.st_mtime_ns):
+			return json.loads(row[2])
+		fields = self._refresh_json(json_path, st)[1]
+		if fields is None:
+			# Json non valido: l'errore vero lo dà load_metadata_fields
+			return load_metadata_fields(json_path)
+		return fields
+
+	def is_current(self, json_path, media_paths):
+		if self.force or len(media_paths) == 0:
+			return False
+		h = self.json_hash(json_path) + self.mode
+		for media_path in media_paths:
+			media_path = os.path.abspath(media_path)
+			row = self.conn.execute("SELECT size, mtime_ns, json_hash FROM media WHERE path = ?", (media_path,)).fetchone()
+			if row is None:
+				return False
+			st = os.stat(media_path)
+			if row != (st.st_size, st.st_mtime_ns, h):
+				return False
+		return True
+
+	def record(self, json_path, media_path):
+		h = self.json_hash(json_path) + self.mode
+		media_path = os.path.abspath(media_path)
+		st = os.stat(media_path)
+		self.conn.execute("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)", (media_path, st.st_size, st.st_mtime_ns, h))
+
+	def commit(self):
+		self.conn.commit()
+
+	def close(self):
+		self.conn.commit()
+		self.conn.close()
+
+def iter_metadata_pairs(json_filenames, n_prefix, media_index):
+	"""Genera le coppie (json, media corrispondenti), con il match per prefisso di add_exif_metadata."""
+	for filename in json_filenames:
+		prefix = filename if n_prefix is None else filename[:n_prefix]
+		yield filename, find_media(media_index, prefix)
+
 # dry_run only detects the files
-def add_exif_metadata(filename, metadata_dir_path, dir_path, dry_run = False, n_prefix = None, et = None, silent = None):
+# With a manifest, the files already up to date are skipped (returns False)
+# If pending is a list, the writes are appended to it (see write_exif_batch) instead of being executed
+# fields are the fields of the json already extracted (see load_metadata_fields), if known
+def add_exif_metadata(filename, metadata_dir_path, dir_path, dry_run = False, n_prefix = None, et = None, silent = None, pending = None, media_index = None, manifest = None, sidecar = False, fields = None):
 	if silent is None:
 		silent = not dry_run
 	# Match basato sui primi N caratteri
@@ -143,10 +1010,9 @@ def add_exif_metadata(filename, metadata_dir_path, dir_path, dry_run = False, n_
 		img_filename_prefix = filename
 	else:
 		img_filename_prefix = filename[:n_prefix]
-	matching_imgs = [
-		f for f in os.listdir(dir_path)
-		if f.startswith(img_filename_prefix) and not f.endswith('.json')
-	]
+	if media_index is None:
+		media_index = build_media_index(dir_path)
+	matching_imgs = find_media(media_index, img_filename_prefix)
 
 	if len(matching_imgs) > 1:
 		# Anomaly?
@@ -161,8 +1027,16 @@ def add_exif_metadata(filename, metadata_dir_path, dir_path, dry_run = False, n_
 	if dry_run:
 		return
 
-	with open(os.path.join(metadata_dir_path, filename), 'r', encoding='utf-8') as f:
-		data = json.load(f)
+	metadata_path = os.path.join(metadata_dir_path, filename)
+	if manifest is not None and manifest.is_current(metadata_path, [os.path.join(dir_path, img) for img in matching_imgs]):
+		return False
+
+	if fields is not None:
+		data = fields
+	elif manifest is not None:
+		data = manifest.metadata_fields(metadata_path)
+	else:
+		data = load_metadata_fields(metadata_path)
 
 	title, author, post_date, tags = parse_metadata(data)
 
@@ -175,17 +1049,296 @@ def add_exif_metadata(filename, metadata_dir_path, dir_path, dry_run = False, n_
 			print(f"Data: {post_date}")
 			print(img, "\t", filename)
 
-		write_exif(
-			et,
+		item = dict(
 			image_path=os.path.join(dir_path, img),
 			title=title,
 			author=author,
 			post_date=post_date,
 			keywords=tags,
-			silent = silent,
+			metadata_path=metadata_path,
+		)
+		if pending is not None:
+			pending.append(item)
+		else:
+			write_exif(et, item["image_path"], title, author, post_date, tags, silent = silent, sidecar = sidecar)
+			if manifest is not None:
+				manifest.record(metadata_path, item["image_path"])
+	return True
+
+def flush_exif_batch(et, pending, failures, manifest = None, verbose = True, sidecar = False):
+	"""
+	Scrive in blocco le scritture accumulate in pending, e registra in failures quelle fallite.
+	Restituisce le coppie (json, media) scritte con successo.
+	"""
+	if len(pending) == 0:
+		return []
+	written = []
+	errors = write_exif_batch(et, pending, silent = True, sidecar = sidecar)
+	for item, error in zip(pending, errors):
+		if error is not None:
+			failures.append((item["image_path"], error))
+		else:
+			written.append((item["metadata_path"], item["image_path"]))
+			if manifest is not None and item["metadata_path"] is not None:
+				manifest.record(item["metadata_path"], item["image_path"])
+		if verbose:
+			print("-" if error is None else "X", end="")
+	if manifest is not None:
+		manifest.commit()
+	sys.stdout.flush()
+	pending.clear()
+	return written
+
+class ExifTagger:
+	"""
+	Tagging in linea, man mano che i media vengono scaricati (vedi instagram-list.py --tag).
+	Un thread con una sessione exiftool persistente riceve path e metadati direttamente dai
+	downloader e li scrive a blocchi con write_exif_batch: niente scansione delle directory
+	né rilettura dei json. Si può usare da più thread; close() aspetta le ultime scritture
+	e restituisce la lista dei file falliti, con il relativo errore.
+	Se il thread si ferma (es. exiftool non parte o termina di colpo) submit() e close()
+	sollevano l'errore, invece di accodare media che nessuno scriverà più.
+	"""
+	def __init__(self, batch_size = EXIF_BATCH_SIZE, manifest_path = EXIF_MANIFEST_FILE, sidecar = False):
+		self.batch_size = max(batch_size, 1)
+		self.manifest_path = manifest_path
+		self.sidecar = sidecar
+		self.queue = queue.Queue()
+		self.failures = []
+		self.error = None
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	def submit(self, media_paths, data, metadata_path = None):
+		"""
+		Accoda i media scaricati, con i metadati (info di yt-dlp o kwdict di gallery-dl) da cui provengono.
+		Se c'è, metadata_path è il json corrispondente: i media scritti vengono registrati nel manifest.
+		"""
+		if self.error is not None:
+			raise Exception(f"EXIF tagging stopped: {self.error}") from self.error
+		title, author, post_date, tags = parse_metadata(data)
+		for media_path in media_paths:
+			self.queue.put(dict(
+				image_path=media_path,
+				title=title,
+				author=author,
+				post_date=post_date,
+				keywords=tags,
+				metadata_path=metadata_path,
+			))
+
+	def _run(self):
+		manifest = None
+		try:
+			if self.manifest_path is not None:
+				manifest = ExifManifest(self.manifest_path, sidecar = self.sidecar)
+			with ExifToolHelper() as et:
+				stop = False
+				while not stop:
+					# Aspetta il primo media, poi prende quelli già in coda fino a batch_size
+					pending = []
+					item = self.queue.get()
+					while item is not None:
+						pending.append(item)
+						if len(pending) >= self.batch_size:
+							break
+						try:
+							item = self.queue.get_nowait()
+						except queue.Empty:
+							break
+					stop = item is None
+					flush_exif_batch(et, pending, self.failures, manifest = manifest, verbose = False, sidecar = self.sidecar)
+					if not et.running:
+						# Terminato durante il blocco: i successivi fallirebbero tutti
+						raise Exception("exiftool terminated unexpectedly")
+		except Exception as e:
+			self.error = e
+		finally:
+			if manifest is not None:
+				manifest.close()
+
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+		if self.error is not None:
+			raise self.error
+		return self.failures
+
+def plan_exif_shards(json_filenames, n_prefix, media_index, shard_size):
+	"""
+	Divide i json in shard indipendenti per i worker di integrate_json_parallel.
+	I json che condividono dei media finiscono nello stesso shard, in ordine alfabetico,
+	così ogni media viene scritto da un solo worker e nello stesso ordine di un'esecuzione
+	seriale: il risultato non dipende dal numero di worker.
+	Ogni shard è una lista di (json, media corrispondenti).
+	"""
+	groups = []
+	group_of_media = {}
+	for filename, matches in iter_metadata_pairs(sorted(json_filenames), n_prefix, media_index):
+		owners = sorted(set(group_of_media[m] for m in matches if m in group_of_media))
+		if len(owners) == 0:
+			target = len(groups)
+			groups.append([])
+		else:
+			# Unisce i gruppi che hanno media in comune con questo json
+			target = owners[0]
+			for owner in owners[1:]:
+				for entry in groups[owner]:
+					for m in entry[1]:
+						group_of_media[m] = target
+				groups[target].extend(groups[owner])
+				groups[owner] = None
+			groups[target].sort()
+		groups[target].append((filename, matches))
+		for m in matches:
+			group_of_media[m] = target
+
+	shards = []
+	shard = []
+	for group in groups:
+		if group is None:
+			continue
+		shard.extend(group)
+		if len(shard) >= shard_size:
+			shards.append(shard)
+			shard = []
+	if len(shard) > 0:
+		shards.append(shard)
+	return shards
+
+# Stato dei processi worker di integrate_json_parallel
+_worker_et = None
+_worker_progress = None
+
+def _init_exif_worker(progress):
+	global _worker_et, _worker_progress
+	# Una sessione exiftool per worker, chiusa quando il processo termina
+	_worker_et = ExifToolHelper()
+	_worker_et.run()
+	multiprocessing_util.Finalize(_worker_et, _worker_et.terminate, exitpriority=10)
+	_worker_progress = progress
+
+def _integrate_exif_shard(args):
+	metadata_dir_path, dir_path, n_prefix, shard, fields, batch_size, sidecar = args
+	failures = []
+	written = []
+	pending = []
+	# json il cui esito non è ancora noto: il progresso avanza solo dopo la scrittura del blocco
+	n_unflushed = 0
+	for (filename, matches), json_fields in zip(shard, fields):
+		try:
+			# Gli unici media candidati sono quelli già trovati dal processo principale
+			add_exif_metadata(filename, metadata_dir_path, dir_path, n_prefix = n_prefix, dry_run = False, et = _worker_et, pending = pending, media_index = matches, fields = json_fields)
+		except Exception as e:
+			failures.append((filename, e))
+		n_unflushed += 1
+		if len(pending) >= max(batch_size, 1):
+			written += flush_exif_batch(_worker_et, pending, failures, verbose = False, sidecar = sidecar)
+			with _worker_progress.get_lock():
+				_worker_progress.value += n_unflushed
+			n_unflushed = 0
+	written += flush_exif_batch(_worker_et, pending, failures, verbose = False, sidecar = sidecar)
+	with _worker_progress.get_lock():
+		_worker_progress.value += n_unflushed
+	# Le eccezioni non sono sempre serializzabili: al processo principale arriva il messaggio
+	return [(path, str(error)) for path, error in failures], written
+
+def integrate_json_parallel(metadata_dir_path, dir_path, n_prefix, json_filenames, media_index, n_workers, batch_size = EXIF_BATCH_SIZE, manifest = None, sidecar = False):
+	"""
+	Scrive i metadati con n_workers processi, ognuno con la propria sessione exiftool.
+	Il manifest viene letto e aggiornato solo dal processo principale, che passa ai worker
+	i campi dei json già presenti nella sua cache (gli altri li estraggono i worker).
+	Restituisce la lista (ordinata) dei file falliti, con il relativo errore.
+	"""
+	if manifest is not None:
+		json_filenames = [
+			filename for filename, matches in iter_metadata_pairs(json_filenames, n_prefix, media_index)
+			if not manifest.is_current(
+				os.path.join(metadata_dir_path, filename),
+				[os.path.join(dir_path, img) for img in matches]
+			)
+		]
+		print(f"{len(json_filenames)} json's to (re)write.")
+	shard_size = batch_size if batch_size else max(1, len(json_filenames) // (n_workers * 8))
+	shards = plan_exif_shards(json_filenames, n_prefix, media_index, shard_size)
+	fields = {}
+	if manifest is not None:
+		for filename in json_filenames:
+			try:
+				fields[filename] = manifest.metadata_fields(os.path.join(metadata_dir_path, filename))
+			except Exception:
+				# L'errore lo riporta il worker
+				pass
+		manifest.commit()
+	progress = multiprocessing.Value("i", 0)
+	with multiprocessing.Pool(n_workers, initializer = _init_exif_worker, initargs = (progress,)) as pool:
+		result = pool.map_async(
+			_integrate_exif_shard,
+			[(metadata_dir_path, dir_path, n_prefix, shard, [fields.get(filename) for filename, _ in shard], batch_size, sidecar) for shard in shards],
+			chunksize = 1,
 		)
+		while not result.ready():
+			result.wait(1)
+			print(f"\r{progress.value} / {len(json_filenames)}", end="")
+			sys.stdout.flush()
+		# map_async mantiene l'ordine degli shard: il report è deterministico
+		failures = []
+		for shard_failures, written in result.get():
+			failures += shard_failures
+			if manifest is not None:
+				for metadata_path, image_path in written:
+					manifest.record(metadata_path, image_path)
+		if manifest is not None:
+			manifest.commit()
+	print()
+	return failures
+
+def print_throughput(n_files, n_bytes, start, end = ""):
+	elapsed = max(time.monotonic() - start, 1e-6)
+	print(f"\r{n_files} files, {n_files / elapsed:.1f} files/s, {n_bytes / elapsed / 2**20:.1f} MB/s", end = end)
+	sys.stdout.flush()
 
-def integrate_json(et, dir_path, n_prefix, do_precheck = True):
+def stream_integrate_json(et, metadata_dir_path, dir_path, n_prefix, json_filenames, media_index, report_path, batch_size = EXIF_BATCH_SIZE, manifest = None, sidecar = False):
+	"""
+	Integrazione non interattiva in un solo passaggio: ogni json viene validato e scritto appena incontrato.
+	Le anomalie (0 o più di 1 media corrispondenti) e gli errori finiscono in report_path invece che su stdout.
+	"""
+	pending = []
+	failures = []
+	n_anomalies = 0
+	n_files = 0
+	n_bytes = 0
+	start = last_print = time.monotonic()
+	with open(report_path, 'w', encoding='utf-8') as report:
+		for filename, matches in iter_metadata_pairs(json_filenames, n_prefix, media_index):
+			if len(matches) != 1:
+				n_anomalies += 1
+				report.write(f"[{len(matches)}] {filename}\t{' '.join(matches)}\n")
+				if len(matches) == 0:
+					continue
+			try:
+				add_exif_metadata(filename, metadata_dir_path, dir_path, n_prefix = n_prefix, et = et, pending = pending, media_index = matches, manifest = manifest)
+			except Exception as e:
+				failures.append((filename, e))
+			if len(pending) >= max(batch_size, 1):
+				# Contano solo i file effettivamente scritti, cioè dopo l'esito del blocco
+				for _, image_path in flush_exif_batch(et, pending, failures, manifest = manifest, verbose = False, sidecar = sidecar):
+					n_files += 1
+					n_bytes += os.path.getsize(image_path)
+			if time.monotonic() - last_print >= 1:
+				print_throughput(n_files, n_bytes, start)
+				last_print = time.monotonic()
+		for _, image_path in flush_exif_batch(et, pending, failures, manifest = manifest, verbose = False, sidecar = sidecar):
+			n_files += 1
+			n_bytes += os.path.getsize(image_path)
+		if manifest is not None:
+			manifest.commit()
+		for path, error in failures:
+			report.write(f"Failed: {path} ({error})\n")
+	print_throughput(n_files, n_bytes, start, end = "\n")
+	print(f"{n_anomalies} anomalies, {len(failures)} failures (see {report_path})")
+
+def integrate_json(et, dir_path, n_prefix, do_precheck = True, batch_size = EXIF_BATCH_SIZE, n_workers = 1, manifest = None, assume_yes = False, report_path = None, sidecar = False):
 	if not os.path.isdir(dir_path):
 		print(f"Directory '{dir_path}' non trovata. Esco.")
 		return
@@ -195,28 +1348,91 @@ def integrate_json(et, dir_path, n_prefix, do_precheck = True):
 		return
 	json_filenames = list(filter(lambda filename: filename.endswith('.json'), os.listdir(metadata_dir_path)))
 	print(f"Found {len(json_filenames)} json's.")
+	# Un solo os.listdir per directory, condiviso da pre-check e scrittura
+	media_index = build_media_index(dir_path)
+	if assume_yes:
+		# Modalità non interattiva (es. cron): niente pre-check né conferma
+		if report_path is None:
+			report_path = config.CACHE_DIR / f"exif-report-{os.path.basename(os.path.normpath(dir_path))}.txt"
+		if n_workers > 1:
+			failures = integrate_json_parallel(metadata_dir_path, dir_path, n_prefix, json_filenames, media_index, n_workers, batch_size = batch_size, manifest = manifest, sidecar = sidecar)
+			with open(report_path, 'w', encoding='utf-8') as report:
+				for filename, matches in iter_metadata_pairs(json_filenames, n_prefix, media_index):
+					if len(matches) != 1:
+						report.write(f"[{len(matches)}] {filename}\t{' '.join(matches)}\n")
+				for path, error in failures:
+					report.write(f"Failed: {path} ({error})\n")
+			print(f"{len(failures)} failures (see {report_path})")
+		else:
+			stream_integrate_json(et, metadata_dir_path, dir_path, n_prefix, json_filenames, media_index, report_path, batch_size = batch_size, manifest = manifest, sidecar = sidecar)
+		return
 	if do_precheck:
 		print(f"Pre-check...")
 		for filename in json_filenames:
-			add_exif_metadata(filename, metadata_dir_path, dir_path, n_prefix = n_prefix, dry_run = True, et = et)
+			add_exif_metadata(filename, metadata_dir_path, dir_path, n_prefix = n_prefix, dry_run = True, et = et, media_index = media_index)
 		print("Done!")
 	print("Proceed? (y/N)")
 	if input() in ("y", "yes"):
+		if n_workers > 1:
+			failures = integrate_json_parallel(metadata_dir_path, dir_path, n_prefix, json_filenames, media_index, n_workers, batch_size = batch_size, manifest = manifest, sidecar = sidecar)
+			for path, error in failures:
+				print(f"Failed: {path} ({error})")
+			return
+		if batch_size:
+			# Bulk mode: le scritture vengono accumulate e inviate a exiftool a blocchi
+			pending = []
+			failures = []
+			for filename in json_filenames:
+				try:
+					if add_exif_metadata(filename, metadata_dir_path, dir_path, n_prefix = n_prefix, dry_run = False, et = et, pending = pending, media_index = media_index, manifest = manifest, sidecar = sidecar) is False:
+						print(".", end="")
+				except Exception as e:
+					failures.append((filename, e))
+					print("X", end="")
+				sys.stdout.flush()
+				if len(pending) >= batch_size:
+					flush_exif_batch(et, pending, failures, manifest = manifest, sidecar = sidecar)
+			flush_exif_batch(et, pending, failures, manifest = manifest, sidecar = sidecar)
+			print()
+			for path, error in failures:
+				print(f"Failed: {path} ({error})")
+			return
 		for filename in json_filenames:
 			try:
-				add_exif_metadata(filename, metadata_dir_path, dir_path, n_prefix = n_prefix, dry_run = False, et = et)
+				written = add_exif_metadata(filename, metadata_dir_path, dir_path, n_prefix = n_prefix, dry_run = False, et = et, media_index = media_index, manifest = manifest, sidecar = sidecar)
 			except Exception as e:
 			 	print("X", end="")
 			else:
-			 	print("-", end="")
+			 	print("-" if written else ".", end="")
 			finally:
 				sys.stdout.flush()
+		if manifest is not None:
+			manifest.commit()
 
 
 # add_exif_metadata for all json's
 if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Integrate the downloaded json metadata into the media files.")
+	parser.add_argument("--workers", type=int, default=1, help="number of exiftool processes writing in parallel")
+	parser.add_argument("--force", action="store_true", help="rewrite also the files that the manifest reports as up to date")
+	parser.add_argument("-y", "--yes", action="store_true", help="non-interactive single pass: no pre-check, no confirmation, anomalies go to a report file in the cache directory")
+	parser.add_argument("--sidecar", action="store_true", help="write .xmp sidecars next to the media instead of modifying them")
+	parser.add_argument("--embed-sidecars", action="store_true", help="copy the tags of the .xmp sidecars into the media, then remove the sidecars")
+	args = parser.parse_args()
+
+	if args.embed_sidecars:
+		with ExifToolHelper() as et:
+			for dir_path in (TARGET_DIR + "/video", TARGET_DIR + "/post"):
+				if os.path.isdir(dir_path):
+					for path, error in embed_xmp_sidecars(et, dir_path):
+						print(f"Failed: {path} ({error})")
+		sys.exit(0)
+
+	manifest = ExifManifest(force = args.force, sidecar = args.sidecar)
 	with ExifToolHelper() as et:
 		# Prefix = timestamp of 19 characters
-		integrate_json(et, TARGET_DIR + "/video", 19)
+		integrate_json(et, TARGET_DIR + "/video", 19, n_workers = args.workers, manifest = manifest, assume_yes = args.yes, sidecar = args.sidecar)
 		# Prefix = all but the ending ".json"
-		integrate_json(et, TARGET_DIR + "/post", -5, False)
+		integrate_json(et, TARGET_DIR + "/post", -5, False, n_workers = args.workers, manifest = manifest, assume_yes = args.yes, sidecar = args.sidecar)
+	manifest.close()
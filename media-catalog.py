@@ -0,0 +1,217 @@
+"""
+Catalog of the downloaded media: reads back the metadata written by lib.py (title, author,
+dates, keywords) and stores it in an indexed SQLite database, updated incrementally.
+A file is read again when its size, mtime or ctime change: lib.py restores the mtime
+after writing the tags, but the ctime always moves.
+
+	python media-catalog.py index
+	python media-catalog.py query --author "someone" --year 2021
+"""
+import os
+import sys
+import sqlite3
+import argparse
+
+from exiftool import ExifToolHelper
+
+import config
+import lib
+
+CATALOG_FILE = config.CACHE_DIR / "media-catalog.sqlite3"
+# Numero di file letti con un singolo round trip verso exiftool
+READ_BATCH_SIZE = 500
+
+SOURCES = {
+	"instagram-saved": config.INSTAGRAM_SAVED_DIR,
+	"instagram-liked": config.INSTAGRAM_LIKED_DIR,
+}
+YOUTUBE_PLAYLISTS_DIR = config.TARGET_DIR / "youtube-playlists"
+if YOUTUBE_PLAYLISTS_DIR.is_dir():
+	for playlist_dir in sorted(YOUTUBE_PLAYLISTS_DIR.iterdir()):
+		if playlist_dir.is_dir():
+			SOURCES["youtube-" + playlist_dir.name] = playlist_dir
+
+# Sidecar e file temporanei, da non catalogare
+SKIPPED_EXTENSIONS = (".json", ".xmp", ".part", ".tmp", ".sqlite3")
+
+def open_catalog(path = CATALOG_FILE):
+	conn = sqlite3.connect(str(path))
+	conn.executescript("""
+		CREATE TABLE IF NOT EXISTS media (
+			path TEXT PRIMARY KEY,
+			source TEXT,
+			size INTEGER,
+			mtime_ns INTEGER,
+			title TEXT,
+			author TEXT COLLATE NOCASE,
+			create_date TEXT,
+			year INTEGER
+		);
+		CREATE TABLE IF NOT EXISTS keywords (
+			path TEXT,
+			keyword TEXT COLLATE NOCASE
+		);
+		CREATE INDEX IF NOT EXISTS media_source ON media (source);
+		CREATE INDEX IF NOT EXISTS media_author ON media (author, year);
+		CREATE INDEX IF NOT EXISTS media_year ON media (year);
+		CREATE INDEX IF NOT EXISTS media_create_date ON media (create_date);
+		CREATE INDEX IF NOT EXISTS keywords_keyword ON keywords (keyword);
+		CREATE INDEX IF NOT EXISTS keywords_path ON keywords (path);
+	""")
+	# Cataloghi creati prima che servisse anche la ctime: le righe vecchie verranno rilette una volta
+	if "ctime_ns" not in [row[1] for row in conn.execute("PRAGMA table_info(media)")]:
+		conn.execute("ALTER TABLE media ADD COLUMN ctime_ns INTEGER")
+	return conn
+
+def scan_media(root):
+	"""Elenca ricorsivamente (path, size, mtime_ns, ctime_ns) dei media sotto root, saltando le cartelle metadata e metadata-only."""
+	stack = [str(root)]
+	while stack:
+		with os.scandir(stack.pop()) as it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks=False):
+					if entry.name not in ("metadata", "metadata-only"):
+						stack.append(entry.path)
+				elif entry.is_file() and not entry.name.endswith(SKIPPED_EXTENSIONS):
+					st = entry.stat()
+					yield entry.path, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+def first_value(tags, name):
+	"""Il primo valore non vuoto di un tag, in qualunque gruppo (es. 'XMP:Title' o 'QuickTime:Title')."""
+	for key, value in tags.items():
+		if key.split(":")[-1] == name and value not in (None, ""):
+			return value
+	return None
+
+def parse_tags(tags):
+	title = first_value(tags, "Title")
+	author = first_value(tags, "Author")
+	create_date = None
+	for name in lib.EXIF_DATE_TAGS:
+		value = first_value(tags, name)
+		# Formato exiftool 'YYYY:MM:DD HH:MM:SS' -> 'YYYY-MM-DD HH:MM:SS'
+		if value is not None and len(str(value)) >= 19 and not str(value).startswith("0000"):
+			value = str(value)
+			create_date = value[:10].replace(":", "-") + " " + value[11:19]
+			break
+	keywords = first_value(tags, "Keywords")
+	if keywords is None:
+		keywords = []
+	elif isinstance(keywords, list):
+		keywords = [str(k) for k in keywords]
+	else:
+		keywords = [k.strip() for k in str(keywords).split(",") if k.strip()]
+	return (
+		None if title is None else str(title),
+		None if author is None else str(author),
+		create_date,
+		keywords,
+	)
+
+def read_tags(et, paths):
+	"""get_tags a blocchi; se il blocco fallisce (es. un file illeggibile) legge un file alla volta."""
+	try:
+		result = et.get_tags(paths, tags = lib.EXIF_TAG_NAMES)
+		if len(result) == len(paths):
+			return result
+	except Exception:
+		pass
+	result = []
+	for path in paths:
+		try:
+			result.append(et.get_tags(path, tags = lib.EXIF_TAG_NAMES)[0])
+		except Exception as e:
+			print(f"Warning: cannot read {path} ({e})")
+			result.append({})
+	return result
+
+def update_catalog(conn, et, batch_size = READ_BATCH_SIZE):
+	indexed = {
+		path: (source, size, mtime_ns, ctime_ns)
+		for path, source, size, mtime_ns, ctime_ns in conn.execute("SELECT path, source, size, mtime_ns, ctime_ns FROM media")
+	}
+	seen = set()
+	scanned_sources = set()
+	for source, root in SOURCES.items():
+		if not os.path.isdir(root):
+			# Disco non montato o simili: i file di questa sorgente restano nel catalogo
+			print(f"{source}: {root} not found, skipped")
+			continue
+		scanned_sources.add(source)
+		to_read = []
+		for path, size, mtime_ns, ctime_ns in scan_media(root):
+			seen.add(path)
+			if indexed.get(path) != (source, size, mtime_ns, ctime_ns):
+				to_read.append((path, size, mtime_ns, ctime_ns))
+		print(f"{source}: {len(to_read)} new or changed files")
+
+		for i in range(0, len(to_read), batch_size):
+			batch = to_read[i:i+batch_size]
+			for (path, size, mtime_ns, ctime_ns), tags in zip(batch, read_tags(et, [path for path, _, _, _ in batch])):
+				title, author, create_date, keywords = parse_tags(tags)
+				year = int(create_date[:4]) if create_date else None
+				conn.execute(
+					"INSERT OR REPLACE INTO media (path, source, size, mtime_ns, ctime_ns, title, author, create_date, year) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+					(path, source, size, mtime_ns, ctime_ns, title, author, create_date, year)
+				)
+				conn.execute("DELETE FROM keywords WHERE path = ?", (path,))
+				conn.executemany("INSERT INTO keywords VALUES (?, ?)", [(path, k) for k in keywords])
+			conn.commit()
+			print(f"\r{min(i + batch_size, len(to_read))} / {len(to_read)}", end="")
+			sys.stdout.flush()
+		if len(to_read) > 0:
+			print()
+
+	removed = [path for path, row in indexed.items() if row[0] in scanned_sources and path not in seen]
+	for path in removed:
+		conn.execute("DELETE FROM media WHERE path = ?", (path,))
+		conn.execute("DELETE FROM keywords WHERE path = ?", (path,))
+	conn.commit()
+	print(f"Removed {len(removed)} missing files.")
+
+def query_catalog(conn, author = None, year = None, keyword = None, source = None, title = None):
+	query = "SELECT path, author, create_date, title FROM media"
+	conditions = []
+	params = []
+	if author is not None:
+		conditions.append("author = ?")
+		params.append(author)
+	if year is not None:
+		conditions.append("year = ?")
+		params.append(year)
+	if source is not None:
+		conditions.append("source = ?")
+		params.append(source)
+	if title is not None:
+		conditions.append("title LIKE ?")
+		params.append(f"%{title}%")
+	if keyword is not None:
+		conditions.append("path IN (SELECT path FROM keywords WHERE keyword = ?)")
+		params.append(keyword)
+	if conditions:
+		query += " WHERE " + " AND ".join(conditions)
+	query += " ORDER BY create_date"
+	return conn.execute(query, params).fetchall()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Index the metadata of the downloaded media and query it.")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+	subparsers.add_parser("index", help="add new/changed media to the catalog, drop the missing ones")
+	query_parser = subparsers.add_parser("query", help="search the catalog")
+	query_parser.add_argument("--author")
+	query_parser.add_argument("--year", type=int)
+	query_parser.add_argument("--keyword")
+	query_parser.add_argument("--source", choices=sorted(SOURCES))
+	query_parser.add_argument("--title", help="substring of the title")
+	args = parser.parse_args()
+
+	conn = open_catalog()
+	if args.command == "index":
+		with ExifToolHelper() as et:
+			update_catalog(conn, et)
+	else:
+		rows = query_catalog(conn, args.author, args.year, args.keyword, args.source, args.title)
+		for path, author, create_date, title in rows:
+			print(f"{create_date}\t{author}\t{path}")
+		print(f"{len(rows)} files.")
+	conn.close()